@@ -4,4 +4,5 @@ CREATE EXTENSION hstore;
 
 \c borders
 CREATE EXTENSION postgis;
+CREATE EXTENSION pg_trgm;
 
@@ -14,11 +14,98 @@ CREATE TABLE borders (
 	count_k INTEGER,
 	modified TIMESTAMP NOT NULL,
 	cmnt VARCHAR(500),
-	mwm_size_est REAL
+	mwm_size_est REAL,
+	geom_simple1 geometry, -- geom simplified with tolerance 0.01
+	geom_simple2 geometry, -- geom simplified with tolerance 0.1
+	area_km2 DOUBLE PRECISION, -- geodesic area, may be NaN
+	npoints INTEGER,
+	bbox box2d,
+	admin_level INTEGER -- admin_level of the same id in osm_borders, refreshed by load_borders.sh
 );
 CREATE INDEX borders_geom_gits_idx ON borders USING gist (geom);
 CREATE INDEX borders_parent_id_idx ON borders (parent_id);
 
+-- Keep columns derived from geometry and id up to date.
+-- ST_SimplifyPreserveTopology is used since ST_Simplify would give NULL
+-- for very little regions.
+CREATE FUNCTION borders_geom_changed() RETURNS trigger AS $$
+BEGIN
+	NEW.geom_simple1 := ST_SimplifyPreserveTopology(NEW.geom, 0.01);
+	NEW.geom_simple2 := ST_SimplifyPreserveTopology(NEW.geom, 0.1);
+	NEW.area_km2 := ST_Area(geography(NEW.geom))/1E6;
+	NEW.npoints := ST_NPoints(NEW.geom);
+	NEW.bbox := Box2D(NEW.geom);
+	NEW.admin_level := (SELECT admin_level FROM osm_borders
+	                    WHERE osm_id = NEW.id);
+	RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER borders_geom_changed_trg
+	BEFORE INSERT OR UPDATE OF geom, id ON borders
+	FOR EACH ROW EXECUTE FUNCTION borders_geom_changed();
+CREATE INDEX borders_area_km2_idx ON borders (area_km2);
+-- for ILIKE '%...%' search by name
+CREATE INDEX borders_name_trgm_idx ON borders USING gin (name gin_trgm_ops);
+
+-- Web server processes keep the region hierarchy in memory and reload it
+-- when the last value of the sequence changes. Writers only call nextval(),
+-- so they don't block each other. The row trigger is deferred to commit
+-- time, but the new value is still seen before the commit is. So writers
+-- hold a shared advisory lock from nextval() till the end of the commit,
+-- and borders_hierarchy_stable_version() returns the version only when
+-- no such commit is in progress, i.e. when all changes up to the version
+-- are visible. A hierarchy loaded after reading it may be cached.
+-- The transaction-local setting tells the writing transaction itself that
+-- its cached hierarchy is outdated: it is set to a new value of the change
+-- sequence by each statement changing the hierarchy.
+CREATE SEQUENCE borders_hierarchy_version_seq;
+CREATE SEQUENCE borders_hierarchy_change_seq;
+
+CREATE FUNCTION borders_hierarchy_changed() RETURNS trigger AS $$
+BEGIN
+	PERFORM pg_advisory_xact_lock_shared(hashtext('borders_hierarchy'));
+	PERFORM nextval('borders_hierarchy_version_seq');
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION borders_hierarchy_changing() RETURNS trigger AS $$
+BEGIN
+	PERFORM set_config('borders.hierarchy_changed',
+	                   nextval('borders_hierarchy_change_seq')::text, TRUE);
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION borders_hierarchy_stable_version() RETURNS BIGINT AS $$
+DECLARE
+	version BIGINT;
+BEGIN
+	IF NOT pg_try_advisory_lock(hashtext('borders_hierarchy')) THEN
+		RETURN NULL;
+	END IF;
+	SELECT last_value INTO version FROM borders_hierarchy_version_seq;
+	PERFORM pg_advisory_unlock(hashtext('borders_hierarchy'));
+	RETURN version;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE CONSTRAINT TRIGGER borders_hierarchy_changed_trg
+	AFTER INSERT OR DELETE OR UPDATE OF id, parent_id, name, admin_level
+	ON borders
+	DEFERRABLE INITIALLY DEFERRED
+	FOR EACH ROW EXECUTE FUNCTION borders_hierarchy_changed();
+
+CREATE TRIGGER borders_hierarchy_changing_trg
+	AFTER INSERT OR DELETE OR UPDATE OF id, parent_id, name, admin_level OR TRUNCATE
+	ON borders
+	FOR EACH STATEMENT EXECUTE FUNCTION borders_hierarchy_changing();
+
+CREATE TRIGGER borders_hierarchy_truncated_trg
+	AFTER TRUNCATE ON borders
+	FOR EACH STATEMENT EXECUTE FUNCTION borders_hierarchy_changed();
+
 CREATE TABLE borders_backup (
 	backup VARCHAR(30) NOT NULL,
 	id BIGINT NOT NULL,
@@ -39,6 +126,38 @@ CREATE TABLE splitting (
     mwm_size_est REAL NOT NULL,
     mwm_size_thr INTEGER NOT NULL, -- mwm size threshold in Kb, 4-bytes INTEGER is enough
     next_level INTEGER NOT NULL,
-    geom geometry NOT NULL
+    geom geometry NOT NULL,
+    geom_simple1 geometry -- geom simplified with tolerance 0.01
 );
 CREATE INDEX splitting_idx ON splitting (osm_border_id, mwm_size_thr, next_level);
+
+-- Common border lengths of adjacent osm_borders of the same admin_level,
+-- filled lazily by autosplitting. Emptied by load_borders.sh.
+CREATE TABLE osm_borders_adjacency (
+    osm_id1 BIGINT NOT NULL,
+    osm_id2 BIGINT NOT NULL, -- osm_id1 < osm_id2
+    length DOUBLE PRECISION NOT NULL, -- in meters, > 0
+    PRIMARY KEY (osm_id1, osm_id2)
+);
+CREATE INDEX osm_borders_adjacency_osm_id2_idx ON osm_borders_adjacency (osm_id2);
+
+-- osm_borders for which all adjacent borders are in osm_borders_adjacency
+CREATE TABLE osm_borders_adjacency_calculated (
+    osm_id BIGINT PRIMARY KEY
+);
+
+-- Queue of long-running operations, executed by borders_daemon.py
+CREATE TABLE jobs (
+    id SERIAL PRIMARY KEY,
+    kind VARCHAR(50) NOT NULL, -- 'divide', 'start_over', 'backup'
+    params JSONB NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued', -- queued, running, done, failed, cancelled
+    progress REAL NOT NULL DEFAULT 0, -- from 0 to 1
+    message TEXT,
+    result JSONB,
+    cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+    created TIMESTAMP NOT NULL DEFAULT now(),
+    started TIMESTAMP,
+    finished TIMESTAMP
+);
+CREATE INDEX jobs_queued_idx ON jobs (id) WHERE status = 'queued';
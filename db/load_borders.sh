@@ -62,9 +62,48 @@ CREATE TABLE osm_borders AS
   GROUP BY osm_id, admin_level
   HAVING coalesce(max(\"name:en\"), max(name)) IS NOT NULL;
 ALTER TABLE osm_borders ADD PRIMARY KEY (osm_id);
+CREATE INDEX osm_borders_way_idx ON osm_borders USING gist (way);
+ALTER TABLE osm_borders ADD COLUMN way_simple1 geometry,
+                        ADD COLUMN area_km2 DOUBLE PRECISION,
+                        ADD COLUMN npoints INTEGER,
+                        ADD COLUMN bbox box2d;
+UPDATE osm_borders
+SET way_simple1 = ST_SimplifyPreserveTopology(way, 0.01),
+    area_km2 = ST_Area(geography(way))/1E6,
+    npoints = ST_NPoints(way),
+    bbox = Box2D(way);
 " || exit 3
 
 # Copy it to the borders database
 echo Copying osm_borders table to the borders database
 pg_dump -O -t osm_borders $DATABASE | psql -U borders $DATABASE_BORDERS
 
+# Cached adjacency of osm borders is outdated after reload
+psql -U borders $DATABASE_BORDERS -c "
+DO \$\$
+BEGIN
+  IF to_regclass('osm_borders_adjacency') IS NOT NULL THEN
+    TRUNCATE osm_borders_adjacency, osm_borders_adjacency_calculated;
+  END IF;
+END
+\$\$;
+"
+
+# Admin levels of borders are copied from osm_borders on insert
+echo Updating admin levels of borders
+psql -U borders $DATABASE_BORDERS -c "
+DO \$\$
+BEGIN
+  IF to_regclass('borders') IS NOT NULL THEN
+    UPDATE borders b
+    SET admin_level = o.admin_level
+    FROM osm_borders o
+    WHERE o.osm_id = b.id AND b.admin_level IS DISTINCT FROM o.admin_level;
+    UPDATE borders b
+    SET admin_level = NULL
+    WHERE b.admin_level IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM osm_borders o WHERE o.osm_id = b.id);
+  END IF;
+END
+\$\$;
+"
@@ -1,27 +1,47 @@
+import heapq
 import itertools
-from collections import defaultdict
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from config import (
         AUTOSPLIT_TABLE as autosplit_table,
+        AUTOSPLIT_WORKERS,
+        OSM_ADJACENCY_CALCULATED_TABLE as osm_adjacency_calculated_table,
+        OSM_ADJACENCY_TABLE as osm_adjacency_table,
         OSM_TABLE as osm_table,
         MWM_SIZE_THRESHOLD,
 )
+from connection_pool import ConnectionPoolException, get_pool
 from subregions import get_subregions_info
 
 
 class DisjointClusterUnion:
-    """Disjoint set union implementation for administrative subregions."""
+    """Disjoint set union implementation for administrative subregions.
 
-    def __init__(self, region_id, subregions, next_level, mwm_size_thr=None):
+    Unfinished clusters are kept in a heap ordered by mwm size estimation
+    and, for equal sizes, by the order of subregions, in which clusters
+    were scanned before. Entries of merged or finished clusters and entries
+    with outdated size are not removed from the heap but skipped when they
+    reach its top.
+    """
+
+    def __init__(self, region_id, subregions, next_level, mwm_size_thr=None,
+                 common_border_matrix=None):
         assert all(s_data['mwm_size_est'] is not None
                     for s_data in subregions.values())
         self.region_id = region_id
         self.subregions = subregions
         self.next_level = next_level
-        self.mwm_size_thr = mwm_size_thr or MWM_SIZE_THRESHOLD
+        self.mwm_size_thr = (MWM_SIZE_THRESHOLD if mwm_size_thr is None
+                             else mwm_size_thr)
         self.representatives = {sub_id: sub_id for sub_id in subregions}
         # A cluster is one or more subregions with common borders
         self.clusters = {}  # representative => cluster object
+        # representative => {adjacent cluster representative => common border length}
+        self.neighbours = {}
+        self._heap = []  # (mwm_size_est, scan position, representative)
+        # A merged cluster keeps the position of its representative
+        self._scan_positions = {sub_id: i for i, sub_id in enumerate(subregions)}
 
         # At the beginning, each subregion forms a cluster.
         # Then they would be enlarged by merging.
@@ -32,16 +52,27 @@ class DisjointClusterUnion:
                 'mwm_size_est': data['mwm_size_est'],
                 'finished': False,  # True if the cluster cannot be merged with another
             }
+            self.neighbours[subregion_id] = {
+                other_id: length
+                for other_id, length in
+                    (common_border_matrix or {}).get(subregion_id, {}).items()
+                if other_id in subregions
+            }
+            self._heap.append((data['mwm_size_est'],
+                               self._scan_positions[subregion_id],
+                               subregion_id))
+        heapq.heapify(self._heap)
 
     def get_smallest_cluster(self):
-        """Find minimal cluster."""
-        smallest_cluster_id = min(
-            (cluster_id for cluster_id in self.clusters.keys()
-                if not self.clusters[cluster_id]['finished']),
-            default=None,
-            key=lambda cluster_id: self.clusters[cluster_id]['mwm_size_est']
-        )
-        return smallest_cluster_id
+        """Find minimal unfinished cluster."""
+        while self._heap:
+            mwm_size_est, _, cluster_id = self._heap[0]
+            cluster = self.clusters.get(cluster_id)
+            if (cluster is not None and not cluster['finished'] and
+                    cluster['mwm_size_est'] == mwm_size_est):
+                return cluster_id
+            heapq.heappop(self._heap)
+        return None
 
     def find_cluster(self, subregion_id):
         if self.representatives[subregion_id] == subregion_id:
@@ -61,8 +92,26 @@ class DisjointClusterUnion:
         r_cluster['mwm_size_est'] += d_cluster['mwm_size_est']
         del self.clusters[dropped_cluster_id]
         self.representatives[dropped_cluster_id] = retained_cluster_id
+        self._merge_neighbours(retained_cluster_id, dropped_cluster_id)
+        if not r_cluster['finished']:
+            heapq.heappush(self._heap,
+                           (r_cluster['mwm_size_est'],
+                            self._scan_positions[retained_cluster_id],
+                            retained_cluster_id))
         return retained_cluster_id
 
+    def _merge_neighbours(self, retained_cluster_id, dropped_cluster_id):
+        """Moves common borders of the dropped cluster to the retained one."""
+        r_neighbours = self.neighbours[retained_cluster_id]
+        d_neighbours = self.neighbours.pop(dropped_cluster_id)
+        r_neighbours.pop(dropped_cluster_id, None)
+        d_neighbours.pop(retained_cluster_id, None)
+        for other_id, length in d_neighbours.items():
+            r_neighbours[other_id] = r_neighbours.get(other_id, 0.0) + length
+            other_neighbours = self.neighbours[other_id]
+            del other_neighbours[dropped_cluster_id]
+            other_neighbours[retained_cluster_id] = r_neighbours[other_id]
+
     def get_cluster_subregion_ids(self, subregion_id):
         """Get all elements in a cluster by subregion_id"""
         representative = self.find_cluster(subregion_id)
@@ -76,20 +125,14 @@ class DisjointClusterUnion:
 
 
 def get_best_cluster_to_join_with(small_cluster_id,
-                                  common_border_matrix,
                                   dcu: DisjointClusterUnion):
-    if small_cluster_id not in common_border_matrix:
-        # This may be if a subregion is isolated,
-        # like Bezirk Lienz inside Tyrol, Austria
-        return None
-    common_borders = defaultdict(float)  # cluster representative => common border length
-    subregion_ids = dcu.get_cluster_subregion_ids(small_cluster_id)
-    for subregion_id in subregion_ids:
-        for other_subregion_id, length in common_border_matrix[subregion_id].items():
-            other_cluster_id = dcu.find_cluster(other_subregion_id)
-            if (other_cluster_id != small_cluster_id and
-                    not dcu.clusters[other_cluster_id]['finished']):
-                common_borders[other_cluster_id] += length
+    # There may be no neighbours if a subregion is isolated,
+    # like Bezirk Lienz inside Tyrol, Austria
+    common_borders = {
+        cluster_id: length
+        for cluster_id, length in dcu.neighbours[small_cluster_id].items()
+            if not dcu.clusters[cluster_id]['finished']
+    }  # cluster representative => common border length
     if not common_borders:
         return None
 
@@ -121,39 +164,136 @@ def get_best_cluster_to_join_with(small_cluster_id,
 
 
 def calculate_common_border_matrix(conn, subregion_ids):
-    subregion_ids_str = ','.join(str(x) for x in subregion_ids)
-    # ST_Length returns 0 if its parameter is a geometry other than
-    # LINESTRING or MULTILINESTRING
+    """Returns common border lengths of the subregions, which are cached
+    in the osm adjacency table.
+    """
+    subregion_ids = list(subregion_ids)
+    calculate_adjacency(conn, subregion_ids)
     with conn.cursor() as cursor:
         cursor.execute(f"""
-            SELECT b1.osm_id AS osm_id1, b2.osm_id AS osm_id2,
-                   ST_Length(geography(ST_Intersection(b1.way, b2.way)))
-            FROM {osm_table} b1, {osm_table} b2
-            WHERE b1.osm_id IN ({subregion_ids_str})
-              AND b2.osm_id IN ({subregion_ids_str})
-              AND b1.osm_id < b2.osm_id
-            """
+            SELECT osm_id1, osm_id2, length
+            FROM {osm_adjacency_table}
+            WHERE osm_id1 = ANY(%(ids)s) AND osm_id2 = ANY(%(ids)s)
+            """, {'ids': subregion_ids}
         )
         common_border_matrix = {}  # {subregion_id: { subregion_id: float} } where len > 0
         for osm_id1, osm_id2, border_len in cursor:
-            if border_len == 0.0:
-                continue
             common_border_matrix.setdefault(osm_id1, {})[osm_id2] = border_len
             common_border_matrix.setdefault(osm_id2, {})[osm_id1] = border_len
     return common_border_matrix
 
 
-def find_golden_splitting(conn, border_id, next_level, mwm_size_thr):
+def calculate_adjacency(conn, osm_ids, commit_conn=False):
+    """Stores common border lengths of the osm borders with all osm borders
+    of the same admin level, if not stored yet. Missing lengths are written
+    in a short transaction, so that it doesn't hold locks on cache rows
+    during the transaction of 'conn': in 'conn' itself, which is committed,
+    if 'commit_conn' is set, or in a free connection of the pool otherwise.
+    If the pool has no free connections, they are written in 'conn'.
+    """
+    ids_to_calculate = _get_ids_without_adjacency(conn, osm_ids)
+    if not ids_to_calculate:
+        return
+    if commit_conn:
+        _calculate_adjacency(conn, ids_to_calculate)
+        conn.commit()
+        return
+    pool = get_pool()
+    try:
+        cache_conn = pool.getconn(timeout=0)
+    except ConnectionPoolException:
+        _calculate_adjacency(conn, ids_to_calculate)
+        return
+    try:
+        _calculate_adjacency(cache_conn, ids_to_calculate)
+        cache_conn.commit()
+    finally:
+        pool.putconn(cache_conn)
+
+
+def _get_ids_without_adjacency(conn, osm_ids):
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT osm_id FROM {osm_adjacency_calculated_table}
+            WHERE osm_id = ANY(%s)
+            """, (list(osm_ids),)
+        )
+        calculated_ids = set(rec[0] for rec in cursor)
+    return sorted(set(osm_ids) - calculated_ids)
+
+
+def _calculate_adjacency(conn, ids_to_calculate):
+    with conn.cursor() as cursor:
+        # Only pairs with overlapping bboxes may have a common border.
+        # Borders of one level don't overlap, so their common border is
+        # the intersection of their boundaries, which is much cheaper
+        # to compute than intersection of polygons.
+        # Pairs of two borders being calculated are processed once.
+        # ST_Length returns 0 if its parameter is a geometry other than
+        # LINESTRING or MULTILINESTRING.
+        # Rows are inserted in key order, so that concurrent sessions
+        # inserting the same pairs wait for each other but don't deadlock.
+        cursor.execute(f"""
+            WITH b AS MATERIALIZED (
+                SELECT osm_id, admin_level, way, ST_Boundary(way) AS boundary
+                FROM {osm_table}
+                WHERE osm_id = ANY(%(ids)s)
+            ), pairs AS (
+                SELECT b.osm_id AS osm_id1, o.osm_id AS osm_id2,
+                       ST_Length(geography(
+                           ST_Intersection(b.boundary, ST_Boundary(o.way))
+                       )) AS length
+                FROM b, {osm_table} o
+                WHERE o.way && b.way
+                  AND o.admin_level = b.admin_level
+                  AND o.osm_id != b.osm_id
+                  AND NOT (o.osm_id = ANY(%(ids)s) AND o.osm_id < b.osm_id)
+                  AND ST_Intersects(b.boundary, o.way)
+            )
+            INSERT INTO {osm_adjacency_table} (osm_id1, osm_id2, length)
+              SELECT least(osm_id1, osm_id2), greatest(osm_id1, osm_id2), length
+              FROM pairs
+              WHERE length > 0
+              ORDER BY 1, 2
+            ON CONFLICT DO NOTHING
+            """, {'ids': ids_to_calculate}
+        )
+        cursor.execute(f"""
+            INSERT INTO {osm_adjacency_calculated_table} (osm_id)
+              SELECT unnest(%s::BIGINT[])
+            ON CONFLICT DO NOTHING
+            """, (ids_to_calculate,)
+        )
+
+
+def get_splitting_inputs(conn, border_id, next_level):
+    """Returns subregions with mwm size estimation and the common border
+    matrix of the region, or None if the region cannot be split.
+    The inputs don't depend on mwm size threshold.
+    """
     subregions = get_subregions_info(conn, border_id, osm_table,
                                      next_level, need_cities=True)
     if not subregions:
-        return
+        return None
     if any(s_data['mwm_size_est'] is None for s_data in subregions.values()):
-        return
+        return None
+    common_border_matrix = calculate_common_border_matrix(conn, subregions.keys())
+    return subregions, common_border_matrix
+
 
-    dcu = DisjointClusterUnion(border_id, subregions, next_level, mwm_size_thr)
-    all_subregion_ids = dcu.get_all_subregion_ids()
-    common_border_matrix = calculate_common_border_matrix(conn, all_subregion_ids)
+def find_golden_splitting(conn, border_id, next_level, mwm_size_thr):
+    inputs = get_splitting_inputs(conn, border_id, next_level)
+    if inputs is None:
+        return None
+    subregions, common_border_matrix = inputs
+    return merge_subregions(border_id, subregions, common_border_matrix,
+                            next_level, mwm_size_thr)
+
+
+def merge_subregions(border_id, subregions, common_border_matrix,
+                     next_level, mwm_size_thr):
+    dcu = DisjointClusterUnion(border_id, subregions, next_level, mwm_size_thr,
+                               common_border_matrix)
 
     while True:
         if len(dcu.clusters) == 1:
@@ -162,7 +302,6 @@ def find_golden_splitting(conn, border_id, next_level, mwm_size_thr):
         if not smallest_cluster_id:
             return dcu
         best_cluster_id = get_best_cluster_to_join_with(smallest_cluster_id,
-                                                        common_border_matrix,
                                                         dcu)
         if not best_cluster_id:
             dcu.clusters[smallest_cluster_id]['finished'] = True
@@ -174,47 +313,78 @@ def find_golden_splitting(conn, border_id, next_level, mwm_size_thr):
 
 def get_union_sql(subregion_ids):
     assert(len(subregion_ids) > 0)
-    if len(subregion_ids) == 1:
-        return f"""
-            SELECT way FROM {osm_table} WHERE osm_id={subregion_ids[0]}
+    subregion_ids_str = ','.join(str(x) for x in subregion_ids)
+    return f"""
+        SELECT ST_Union(way) FROM {osm_table} WHERE osm_id IN ({subregion_ids_str})
         """
-    else:
-        return f"""
-            SELECT ST_Union(
-              ({get_union_sql(subregion_ids[0:1])}),
-              ({get_union_sql(subregion_ids[1:])})
-            )
-            """
 
 
 def save_splitting_to_db(conn, dcu: DisjointClusterUnion):
+    """Replaces the splitting of the region by the clusters of 'dcu'
+    with one DELETE and one INSERT in a single transaction.
+    """
+    _save_splitting(conn, dcu)
+    conn.commit()
+
+
+def _save_splitting(conn, dcu: DisjointClusterUnion):
+    # Cluster membership is passed as two parallel arrays: ordinality keeps
+    # the order of subregion ids since the first one identifies the cluster.
+    membership_cluster_ids = []
+    membership_subregion_ids = []
+    cluster_ids = []
+    mwm_size_ests = []
+    for cluster_id, data in dcu.clusters.items():
+        membership_cluster_ids.extend([cluster_id] * len(data['subregion_ids']))
+        membership_subregion_ids.extend(data['subregion_ids'])
+        cluster_ids.append(cluster_id)
+        mwm_size_ests.append(data['mwm_size_est'])
+    splitting_sql_params = {
+        'region_id': dcu.region_id,
+        'mwm_size_thr': dcu.mwm_size_thr,
+        'next_level': dcu.next_level,
+        'membership_cluster_ids': membership_cluster_ids,
+        'membership_subregion_ids': membership_subregion_ids,
+        'cluster_ids': cluster_ids,
+        'mwm_size_ests': mwm_size_ests,
+    }
     with conn.cursor() as cursor:
         # Remove previous splitting of the region
         cursor.execute(f"""
             DELETE FROM {autosplit_table}
-            WHERE osm_border_id = {dcu.region_id}
-              AND mwm_size_thr = {dcu.mwm_size_thr}
-              AND next_level = {dcu.next_level}
-            """)
-        for cluster_id, data in dcu.clusters.items():
-            subregion_ids = data['subregion_ids']
-            subregion_ids_array_str = (
-                    '{' + ','.join(str(x) for x in subregion_ids) + '}'
-            )
-            cluster_geometry_sql = get_union_sql(subregion_ids)
-            cursor.execute(f"""
-                INSERT INTO {autosplit_table} (osm_border_id, subregion_ids, geom,
-                                               next_level, mwm_size_thr, mwm_size_est)
-                  VALUES (
-                    {dcu.region_id},
-                    '{subregion_ids_array_str}',
-                    ({cluster_geometry_sql}),
-                    {dcu.next_level},
-                    {dcu.mwm_size_thr},
-                    {data['mwm_size_est']}
-                  )
-                """)
-    conn.commit()
+            WHERE osm_border_id = %(region_id)s
+              AND mwm_size_thr = %(mwm_size_thr)s
+              AND next_level = %(next_level)s
+            """, splitting_sql_params)
+        # geom_simple1 is used for previews; ST_SimplifyPreserveTopology
+        # since ST_Simplify would give NULL for very little regions.
+        cursor.execute(f"""
+            INSERT INTO {autosplit_table} (osm_border_id, subregion_ids,
+                                           geom, geom_simple1, next_level,
+                                           mwm_size_thr, mwm_size_est)
+              SELECT
+                %(region_id)s,
+                c.subregion_ids,
+                c.geom,
+                ST_SimplifyPreserveTopology(c.geom, 0.01),
+                %(next_level)s,
+                %(mwm_size_thr)s,
+                e.mwm_size_est
+              FROM (
+                  SELECT m.cluster_id,
+                         array_agg(m.subregion_id ORDER BY m.ord) AS subregion_ids,
+                         ST_Union(o.way) AS geom
+                  FROM unnest(%(membership_cluster_ids)s::BIGINT[],
+                              %(membership_subregion_ids)s::BIGINT[])
+                            WITH ORDINALITY AS m(cluster_id, subregion_id, ord)
+                      JOIN {osm_table} o ON o.osm_id = m.subregion_id
+                  GROUP BY m.cluster_id
+              ) c
+                JOIN unnest(%(cluster_ids)s::BIGINT[],
+                            %(mwm_size_ests)s::REAL[])
+                        AS e(cluster_id, mwm_size_est)
+                    USING (cluster_id)
+            """, splitting_sql_params)
 
 
 def split_region(conn, region_id, next_level, mwm_size_thr):
@@ -226,3 +396,109 @@ def split_region(conn, region_id, next_level, mwm_size_thr):
     ## May need to debug
     #from auto_split_debug import save_splitting_to_file
     #save_splitting_to_file(conn, dcu)
+
+
+def _calculate_subregions_adjacency(conn, region_ids, next_level):
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT subreg.osm_id
+            FROM {osm_table} reg, {osm_table} subreg
+            WHERE reg.osm_id = ANY(%s) AND subreg.admin_level = %s AND
+                  ST_Contains(reg.way, subreg.way)
+            """, (list(region_ids), next_level)
+        )
+        subregion_ids = [rec[0] for rec in cursor]
+    calculate_adjacency(conn, subregion_ids, commit_conn=True)
+
+
+def split_regions(conn, region_ids, next_level, mwm_size_thr,
+                  progress=None, workers=AUTOSPLIT_WORKERS):
+    """Splits independent regions concurrently and commits the splittings.
+
+    Adjacency of all subregions is cached beforehand, so that splitting
+    only reads it in the connection it runs in: workers splitting neighbour
+    regions don't write the same cache rows and no region needs a second
+    connection. Workers use only connections that are free in the pool
+    at the moment; if there are none, regions are split one by one
+    in 'conn', which is committed.
+    'progress', if given, is called as progress(done, total) after each
+    region and may raise an exception to stop splitting.
+    """
+    if not region_ids:
+        return
+    _calculate_subregions_adjacency(conn, region_ids, next_level)
+
+    pool = get_pool()
+    worker_conns = []
+    if len(region_ids) > 1:
+        for _ in range(min(workers, len(region_ids))):
+            try:
+                worker_conns.append(pool.getconn(timeout=0))
+            except ConnectionPoolException:
+                break
+    try:
+        if not worker_conns:
+            for i, region_id in enumerate(region_ids):
+                split_region(conn, region_id, next_level, mwm_size_thr)
+                if progress:
+                    progress(i + 1, len(region_ids))
+            return
+
+        free_conns = queue.Queue()
+        for worker_conn in worker_conns:
+            free_conns.put(worker_conn)
+
+        def split_region_in_free_connection(region_id):
+            worker_conn = free_conns.get()
+            try:
+                split_region(worker_conn, region_id, next_level, mwm_size_thr)
+            except:
+                worker_conn.rollback()
+                raise
+            finally:
+                free_conns.put(worker_conn)
+
+        with ThreadPoolExecutor(max_workers=len(worker_conns)) as executor:
+            futures = [
+                executor.submit(split_region_in_free_connection, region_id)
+                    for region_id in region_ids
+            ]
+            try:
+                for i, future in enumerate(as_completed(futures)):
+                    future.result()
+                    if progress:
+                        progress(i + 1, len(region_ids))
+            except:
+                # Regions being split now are finished, others are skipped
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        for worker_conn in worker_conns:
+            pool.putconn(worker_conn)
+
+
+def split_region_by_thresholds(conn, region_id, next_level, mwm_size_thrs):
+    """Splits the region with each of the thresholds, fetching subregions
+    and their adjacency once, and saves all splittings in one transaction.
+    Returns the list of {mwm_size_thr, clusters_count, max_mwm_size_est}
+    dicts, or None if the region cannot be split.
+    """
+    inputs = get_splitting_inputs(conn, region_id, next_level)
+    if inputs is None:
+        return None
+    subregions, common_border_matrix = inputs
+    summary = []
+    for mwm_size_thr in mwm_size_thrs:
+        dcu = merge_subregions(region_id, subregions, common_border_matrix,
+                               next_level, mwm_size_thr)
+        _save_splitting(conn, dcu)
+        summary.append({
+            'mwm_size_thr': dcu.mwm_size_thr,
+            'clusters_count': len(dcu.clusters),
+            'max_mwm_size_est': max(
+                cluster['mwm_size_est'] for cluster in dcu.clusters.values()
+            ),
+        })
+    conn.commit()
+    return summary
@@ -9,20 +9,24 @@ from unidecode import unidecode
 from flask import (
         Flask, g,
         request, Response, abort,
-        json, jsonify,
+        jsonify,
         render_template,
-        send_file, send_from_directory
+        send_file, send_from_directory,
+        stream_with_context
 )
 from flask_cors import CORS
 from flask_compress import Compress
 import psycopg2
 
 import config
+from auto_split import split_region_by_thresholds
 from borders_api_utils import *
+from connection_pool import get_pool
 from countries_structure import (
     CountryStructureException,
-    create_countries_initial_structure,
+    recreate_countries_structure,
 )
+from jobs import cancel_job, enqueue_job, get_job
 from osm_xml import (
     borders_from_xml,
     borders_to_xml,
@@ -31,10 +35,10 @@ from osm_xml import (
 from subregions import (
     get_child_region_ids,
     get_parent_region_id,
-    get_region_full_name,
+    get_regions_full_names,
     get_similar_regions,
     is_administrative_region,
-    update_border_mwm_size_estimation,
+    update_borders_mwm_size_estimation,
 )
 
 
@@ -107,14 +111,14 @@ def send_js(path):
 
 @app.before_request
 def before_request():
-    g.conn = psycopg2.connect(config.CONNECTION)
+    g.conn = get_pool().getconn()
 
 
 @app.teardown_request
 def teardown(exception):
     conn = getattr(g, 'conn', None)
     if conn is not None:
-        conn.close()
+        get_pool().putconn(conn)
 
 
 @app.route('/')
@@ -139,17 +143,31 @@ def query_bbox():
     simplify = simplify_level_to_postgis_value(simplify_level)
     borders_table = request.args.get('table')
     borders_table = config.OTHER_TABLES.get(borders_table, config.BORDERS_TABLE)
-    borders = fetch_borders(
+    borders = iterate_borders(
         table=borders_table,
         simplify=simplify,
+        raw_geometry=True,
         where_clause=geom_intersects_bbox_sql(xmin, ymin, xmax, ymax)
     )
-    return jsonify(
+    return stream_jsonify_raw(
         status='ok',
         geojson={'type': 'FeatureCollection', 'features': borders}
     )
 
 
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.mvt')
+def query_tile(z, x, y):
+    if not (0 <= z <= 30 and 0 <= x < 2**z and 0 <= y < 2**z):
+        abort(404)
+    table = request.args.get('table')
+    borders_table = config.OTHER_TABLES.get(table, config.BORDERS_TABLE)
+    layer = table if table in config.OTHER_TABLES else 'borders'
+    tile = fetch_borders_tile(z, x, y, table=borders_table, layer=layer)
+    response = Response(tile, mimetype='application/vnd.mapbox-vector-tile')
+    response.cache_control.max_age = config.MVT_CACHE_MAX_AGE
+    return response
+
+
 @app.route('/small')
 @validate_args_types(xmin=float, xmax=float, ymin=float, ymax=float)
 def query_small_in_bbox():
@@ -159,6 +177,12 @@ def query_small_in_bbox():
     ymax = request.args.get('ymax')
     borders_table = request.args.get('table')
     borders_table = config.OTHER_TABLES.get(borders_table, config.BORDERS_TABLE)
+    # A border of one big polygon has no small rings
+    single_big_polygon_filter = (
+        f"""AND (area_km2 < {config.SMALL_KM2} OR
+                 ST_NumGeometries(geom) > 1)"""
+        if borders_table == config.BORDERS_TABLE else ''
+    )
     with g.conn.cursor() as cursor:
         cursor.execute(f"""
             SELECT id, name, ST_Area(geography(ring))/1E6 AS area,
@@ -167,6 +191,7 @@ def query_small_in_bbox():
                 SELECT id, name, (ST_Dump(geom)).geom AS ring
                 FROM {borders_table}
                 WHERE {geom_intersects_bbox_sql(xmin, ymin, xmax, ymax)}
+                    {single_big_polygon_filter}
             ) g
             WHERE ST_Area(geography(ring))/1E6 < %s
             """, (config.SMALL_KM2,)
@@ -230,6 +255,13 @@ def prepare_sql_search_string(string):
     return string
 
 
+def escape_sql_like_string(string):
+    """Escapes LIKE wildcards, so that they match only themselves"""
+    for char in ('\\', '%', '_'):
+        string = string.replace(char, f"\\{char}")
+    return string
+
+
 @app.route('/search')
 def search():
     query = request.args.get('q')
@@ -237,10 +269,10 @@ def search():
 
     with g.conn.cursor() as cursor:
         cursor.execute(f"""
-            SELECT ST_XMin(geom), ST_YMin(geom), ST_XMax(geom), ST_YMax(geom)
+            SELECT ST_XMin(bbox), ST_YMin(bbox), ST_XMax(bbox), ST_YMax(bbox)
             FROM {config.BORDERS_TABLE}
             WHERE name ILIKE %s
-            ORDER BY (ST_Area(geography(geom)))
+            ORDER BY area_km2
             LIMIT 1""", (sql_search_string,)
         )
         if cursor.rowcount > 0:
@@ -249,6 +281,49 @@ def search():
     return jsonify(status='not found')
 
 
+@app.route('/search_suggest')
+@validate_args_types(limit=(None, int))
+def search_suggest():
+    """Returns regions with names matching the query, for typeahead."""
+    query = request.args.get('q', '')
+    limit = request.args.get('limit')
+    limit = config.SEARCH_SUGGESTIONS_LIMIT if limit is None else int(limit)
+    if limit < 1:
+        return abort(400)
+    limit = min(limit, config.SEARCH_SUGGESTIONS_LIMIT)
+    sql_search_string = prepare_sql_search_string(escape_sql_like_string(query))
+    plain_query = query.strip('^$')
+    prefix_search_string = f"{escape_sql_like_string(plain_query)}%"
+    with g.conn.cursor() as cursor:
+        # Regions with names starting with the query go first
+        cursor.execute(f"""
+            SELECT id, name,
+                   (CASE WHEN area_km2 = 'NaN'::DOUBLE PRECISION THEN 0
+                         ELSE area_km2
+                    END) AS area,
+                   ST_XMin(bbox), ST_YMin(bbox), ST_XMax(bbox), ST_YMax(bbox)
+            FROM {config.BORDERS_TABLE}
+            WHERE name ILIKE %s ESCAPE '\\'
+            ORDER BY name ILIKE %s ESCAPE '\\' DESC,
+                     similarity(name, %s) DESC,
+                     area_km2 DESC
+            LIMIT %s""", (sql_search_string, prefix_search_string,
+                          plain_query, limit)
+        )
+        records = cursor.fetchall()
+    full_names = get_regions_full_names(g.conn, [rec[0] for rec in records])
+    regions = []
+    for region_id, name, area, *bounds in records:
+        regions.append({
+            'id': region_id,
+            'name': name,
+            'full_name': full_names.get(region_id, name),
+            'area': area,
+            'bounds': bounds
+        })
+    return jsonify(status='ok', regions=regions)
+
+
 @app.route('/split')
 @check_write_access
 @validate_args_types(id=int)
@@ -292,7 +367,7 @@ def split():
             # insert new geometries
             counter = 1
             new_ids = []
-            free_id = get_free_id()
+            free_id = get_free_id(g.conn)
             for geom in geometries:
                 cursor.execute(f"""
                     INSERT INTO {borders_table} (id, name, geom, disabled,
@@ -305,12 +380,7 @@ def split():
                 new_ids.append(free_id)
                 counter += 1
                 free_id -= 1
-            warnings = []
-            for border_id in new_ids:
-                try:
-                    update_border_mwm_size_estimation(g.conn, border_id)
-                except Exception as e:
-                    warnings.append(str(e))
+            warnings = update_borders_mwm_size_estimation(g.conn, new_ids)
         g.conn.commit()
     return jsonify(status='ok', warnings=warnings)
 
@@ -326,7 +396,7 @@ def join_borders():
     with g.conn.cursor() as cursor:
         try:
             borders_table = config.BORDERS_TABLE
-            joint_id = get_free_id()
+            joint_id = get_free_id(g.conn)
             cursor.execute(f"""
                     UPDATE {borders_table}
                     SET id = {joint_id},
@@ -424,9 +494,8 @@ def find_osm_borders():
         cursor.execute(f"""
             SELECT osm_id, name, admin_level,
                     (CASE
-                        WHEN ST_Area(geography(way)) = 'NaN'::DOUBLE PRECISION
-                            THEN 0
-                        ELSE ST_Area(geography(way))/1E6
+                        WHEN area_km2 = 'NaN'::DOUBLE PRECISION THEN 0
+                        ELSE area_km2
                     END) AS area_km
             FROM {config.OSM_TABLE} 
             WHERE ST_Contains(way, ST_SetSRID(ST_Point(%s, %s), 4326))
@@ -561,21 +630,46 @@ def divide(preview=False):
             mwm_size_thr = int(request.args.get('mwm_size_thr'))
         except ValueError:
             return jsonify(status="Not a number in thresholds")
-        divide_into_clusters_func = (
-            divide_into_clusters_preview
-            if preview
-            else divide_into_clusters
-        )
-        return divide_into_clusters_func(
-                region_ids, next_level,
-                mwm_size_thr)
     else:
-        divide_into_subregions_func = (
-            divide_into_subregions_preview
-            if preview
-            else divide_into_subregions
-        )
-        return divide_into_subregions_func(region_ids, next_level)
+        mwm_size_thr = None
+    if request.args.get('async') == 'true':
+        job_id = enqueue_job(g.conn, 'divide', {
+            'region_ids': region_ids,
+            'next_level': next_level,
+            'mwm_size_thr': mwm_size_thr,
+            'preview': preview,
+        })
+        g.conn.commit()
+        return jsonify(status='ok', job_id=job_id)
+    result = divide_regions(g.conn, region_ids, next_level,
+                            mwm_size_thr, preview)
+    return jsonify_raw(status='ok', **result)
+
+
+@app.route('/compare_splittings')
+@validate_args_types(id=int, next_level=int)
+def compare_splittings():
+    """Auto-splits a region with several mwm size thresholds at once.
+    Splittings are stored for later preview and division.
+    """
+    region_id = int(request.args.get('id'))
+    next_level = int(request.args.get('next_level'))
+    if not is_administrative_region(g.conn, region_id):
+        return jsonify(status="Could not apply auto-division "
+                              "to non-administrative regions")
+    try:
+        mwm_size_thrs = sorted(set(
+            int(x) for x in request.args.get('thresholds', '').split(',')
+        ))
+    except ValueError:
+        return abort(400)
+    if mwm_size_thrs[0] <= 0:
+        return abort(400)
+    summary = split_region_by_thresholds(g.conn, region_id, next_level,
+                                         mwm_size_thrs)
+    if summary is None:
+        return jsonify(status="Could not split the region")
+    return jsonify(status='ok', splittings=summary)
 
 
 @app.route('/chop1')
@@ -591,7 +685,7 @@ def chop_largest_or_farthest():
         res = cursor.fetchone()
         if not res or res[0] < 2:
             return jsonify(status='border should have more than one outer ring')
-        free_id1 = get_free_id()
+        free_id1 = get_free_id(g.conn)
         free_id2 = free_id1 - 1
         cursor.execute(f"""
             INSERT INTO {borders_table} (id, parent_id, name, disabled,
@@ -614,12 +708,7 @@ def chop_largest_or_farthest():
                     GROUP BY name, disabled)
                 ) x"""
         )
-    warnings = []
-    for border_id in (free_id1, free_id2):
-        try:
-            update_border_mwm_size_estimation(g.conn, border_id)
-        except Exception as e:
-            warnings.append(str(e))
+    warnings = update_borders_mwm_size_estimation(g.conn, [free_id1, free_id2])
     g.conn.commit()
     return jsonify(status='ok', warnings=warnings)
 
@@ -648,26 +737,12 @@ def draw_hull():
 @app.route('/backup')
 @check_write_access
 def backup_do():
-    with g.conn.cursor() as cursor:
-        cursor.execute(f"""
-            SELECT to_char(now(), 'IYYY-MM-DD HH24:MI'), max(backup)
-            FROM {config.BACKUP}
-            """)
-        (timestamp, tsmax) = cursor.fetchone()
-        if timestamp == tsmax:
-            return jsonify(status="please try again later")
-        backup_table = config.BACKUP
-        borders_table = config.BORDERS_TABLE
-        cursor.execute(f"""
-            INSERT INTO {backup_table}
-                 (backup, id, name, parent_id, geom, disabled, count_k,
-                    modified, cmnt, mwm_size_est)
-              SELECT %s, id, name, parent_id, geom, disabled, count_k,
-                    modified, cmnt, mwm_size_est
-              FROM {borders_table}
-            """, (timestamp,)
-        )
-    g.conn.commit()
+    if request.args.get('async') == 'true':
+        job_id = enqueue_job(g.conn, 'backup', {})
+        g.conn.commit()
+        return jsonify(status='ok', job_id=job_id)
+    if not make_backup(g.conn):
+        return jsonify(status="please try again later")
     return jsonify(status='ok')
 
 
@@ -741,12 +816,15 @@ def make_osm():
     ymax = request.args.get('ymax')
     borders_table = request.args.get('table')
     borders_table = config.OTHER_TABLES.get(borders_table, config.BORDERS_TABLE)
-    borders = fetch_borders(
+    borders = iterate_borders(
         table=borders_table,
         where_clause=geom_intersects_bbox_sql(xmin, ymin, xmax, ymax)
     )
-    xml = borders_to_xml(borders)
-    return Response(xml, mimetype='application/x-osm+xml')
+    topology = request.args.get('topology')
+    if topology is not None:
+        topology = (topology == 'true')
+    return Response(stream_with_context(borders_to_xml(borders, topology)),
+                    mimetype='application/x-osm+xml')
 
 
 @app.route('/josmbord')
@@ -785,8 +863,9 @@ def josm_borders_along():
             GROUP BY line
             """, (line, region_id)
         )
-        xml = lines_to_xml(rec[0] for rec in cursor)
-    return Response(xml, mimetype='application/x-osm+xml')
+        lines = [rec[0] for rec in cursor]
+    return Response(stream_with_context(lines_to_xml(lines)),
+                    mimetype='application/x-osm+xml')
 
 
 def import_error(msg):
@@ -853,7 +932,7 @@ def import_osm():
 def potential_parents():
     region_id = int(request.args.get('id'))
     parents = find_potential_parents(region_id)
-    return jsonify(status='ok', parents=parents)
+    return jsonify_raw(status='ok', parents=parents)
 
 
 @app.route('/poly')
@@ -877,6 +956,9 @@ def export_poly():
         fetch_borders_args['where_clause'] = geom_intersects_bbox_sql(xmin, ymin,
                                                                       xmax, ymax)
     borders = fetch_borders(**fetch_borders_args)
+    full_names = get_regions_full_names(
+        g.conn, [border['properties']['id'] for border in borders]
+    )
 
     memory_file = io.BytesIO()
     with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
@@ -887,7 +969,7 @@ def export_poly():
                         else geometry['coordinates'])
             # sanitize name, src: http://stackoverflow.com/a/295466/1297601
             name = border['properties']['name'] or str(-border['properties']['id'])
-            fullname = get_region_full_name(g.conn, border['properties']['id'])
+            fullname = full_names.get(border['properties']['id'], name)
             filename = unidecode(fullname)
             filename = re.sub('[^\w _-]', '', filename).strip()
             filename = filename + '.poly'
@@ -914,11 +996,17 @@ def export_poly():
     return send_file(memory_file, attachment_filename='borders.zip', as_attachment=True)
 
 
+@app.route('/pool_stat')
+def pool_statistics():
+    return jsonify(get_pool().get_stats())
+
+
 @app.route('/stat')
 def statistics():
     group = request.args.get('group')
     borders_table = request.args.get('table')
     borders_table = config.OTHER_TABLES.get(borders_table, config.BORDERS_TABLE)
+    props_sql = border_properties_sql(borders_table)
     with g.conn.cursor() as cursor:
         if group == 'total':
             cursor.execute(f"SELECT count(1) FROM {borders_table}")
@@ -928,50 +1016,53 @@ def statistics():
                 SELECT
                     name,
                     count_k,
-                    ST_NPoints(geom),
-                    ST_AsGeoJSON(ST_Centroid(geom)),
+                    {props_sql['nodes']},
+                    ST_X(ST_Centroid(geom)),
+                    ST_Y(ST_Centroid(geom)),
                     (CASE
-                        WHEN ST_Area(geography(geom)) = 'NaN'::DOUBLE PRECISION
+                        WHEN {props_sql['area']} = 'NaN'::DOUBLE PRECISION
                             THEN 0
-                        ELSE ST_Area(geography(geom))/1E6
+                        ELSE {props_sql['area']}/1E6
                     END) AS area,
                     disabled,
                     (CASE
                         WHEN coalesce(cmnt, '') = '' THEN false
                         ELSE true
                     END) AS cmnt
-                FROM {borders_table}"""
+                FROM {borders_table} t"""
             )
             result = []
             for res in cursor:
-                coord = json.loads(res[3])['coordinates']
-                result.append({'name': res[0], 'lat': coord[1], 'lon': coord[0],
-                               'size': res[1], 'nodes': res[2], 'area': res[4],
-                               'disabled': res[5], 'commented': res[6]})
+                result.append({'name': res[0], 'lat': res[4], 'lon': res[3],
+                               'size': res[1], 'nodes': res[2], 'area': res[5],
+                               'disabled': res[6], 'commented': res[7]})
             return jsonify(regions=result)
         elif group == 'topo':
             cursor.execute(f"""
-                SELECT
-                    name,
-                    count(1),
-                    min(
-                        CASE
-                            WHEN ST_Area(geography(g)) = 'NaN'::DOUBLE PRECISION
-                                THEN 0
-                            ELSE ST_Area(geography(g))
-                        END
-                    ) / 1E6,
-                    sum(ST_NumInteriorRings(g)),
-                    ST_AsGeoJSON(ST_Centroid(ST_Collect(g)))
-                FROM (SELECT name, (ST_Dump(geom)).geom AS g FROM {borders_table}) a
-                GROUP BY name"""
+                SELECT name, outer_cnt, min_area, inner_cnt,
+                       ST_X(centroid), ST_Y(centroid)
+                FROM (
+                    SELECT
+                        name,
+                        count(1) AS outer_cnt,
+                        min(
+                            CASE
+                                WHEN ST_Area(geography(g)) = 'NaN'::DOUBLE PRECISION
+                                    THEN 0
+                                ELSE ST_Area(geography(g))
+                            END
+                        ) / 1E6 AS min_area,
+                        sum(ST_NumInteriorRings(g)) AS inner_cnt,
+                        ST_Centroid(ST_Collect(g)) AS centroid
+                    FROM (SELECT name, (ST_Dump(geom)).geom AS g FROM {borders_table}) a
+                    GROUP BY name
+                ) q"""
             )
             result = []
-            for (name, outer, min_area, inner, coords) in cursor:
-                coord = json.loads(coords)['coordinates']
+            for (name, outer, min_area, inner, lon, lat) in cursor:
                 result.append({'name': name, 'outer': outer,
                                'min_area': min_area, 'inner': inner,
-                               'lon': coord[0], 'lat': coord[1]})
+                               'lon': lon, 'lat': lat})
             return jsonify(regions=result)
     return jsonify(status='wrong group id')
 
@@ -987,25 +1078,47 @@ def border():
         table=borders_table,
         simplify=simplify,
         only_leaves=False,
+        raw_geometry=True,
         where_clause=f'id = {region_id}'
     )
     if not borders:
         return jsonify(status=f'No border with id={region_id} found')
-    return jsonify(status='ok', geojson=borders[0])
+    return jsonify_raw(status='ok', geojson=borders[0])
 
 
 @app.route('/start_over')
 def start_over():
+    if request.args.get('async') == 'true':
+        job_id = enqueue_job(g.conn, 'start_over', {})
+        g.conn.commit()
+        return jsonify(status='ok', job_id=job_id)
     try:
-        create_countries_initial_structure(g.conn)
+        recreate_countries_structure(g.conn)
     except CountryStructureException as e:
         return jsonify(status=str(e))
+    return jsonify(status='ok')
 
-    autosplit_table = config.AUTOSPLIT_TABLE
-    with g.conn.cursor() as cursor:
-        cursor.execute(f"DELETE FROM {autosplit_table}")
+
+@app.route('/job')
+@validate_args_types(id=int)
+def job_status():
+    job = get_job(g.conn, int(request.args.get('id')))
+    if job is None:
+        return jsonify(status='no such job')
+    if job['result'] is not None:
+        job['result'] = RawJSON(job['result'])
+    return jsonify_raw(status='ok', job=job)
+
+
+@app.route('/job_cancel')
+@check_write_access
+@validate_args_types(id=int)
+def job_cancel():
+    job_status = cancel_job(g.conn, int(request.args.get('id')))
     g.conn.commit()
-    return jsonify(status='ok')
+    if job_status is None:
+        return jsonify(status='the job is finished or does not exist')
+    return jsonify(status='ok', job_status=job_status)
 
 
 if __name__ == '__main__':
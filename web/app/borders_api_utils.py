@@ -1,94 +1,227 @@
 import itertools
 import json
+import math
+from collections.abc import Iterator
 
-from flask import g, jsonify
+from flask import g, json as flask_json, Response, stream_with_context
 
 from config import (
     AUTOSPLIT_TABLE as autosplit_table,
+    BACKUP as backup_table,
     BORDERS_TABLE as borders_table,
+    FETCH_BORDERS_CHUNK_SIZE,
+    MVT_BUFFER,
+    MVT_EXTENT,
     OSM_TABLE as osm_table,
 )
-from auto_split import split_region
+from auto_split import split_region, split_regions
+from region_hierarchy import get_region_hierarchy
 from subregions import (
     get_parent_region_id,
-    get_region_country,
     get_subregions_info,
     is_administrative_region,
-    update_border_mwm_size_estimation,
+    update_borders_mwm_size_estimation,
 )
 
 
+class RawJSON(str):
+    """Already serialized JSON value, e.g. GeoJSON geometry from PostGIS,
+    which jsonify_raw() inserts into the response as is.
+    """
+
+
+def _iter_json(obj):
+    """Yields pieces of JSON representation of the object, not encoding
+    RawJSON values once more.
+    """
+    if isinstance(obj, RawJSON):
+        yield obj
+    elif isinstance(obj, dict):
+        yield '{'
+        for i, (key, value) in enumerate(obj.items()):
+            if i > 0:
+                yield ','
+            yield json.dumps(str(key), ensure_ascii=False)
+            yield ':'
+            yield from _iter_json(value)
+        yield '}'
+    elif isinstance(obj, (list, tuple, Iterator)):
+        yield '['
+        for i, value in enumerate(obj):
+            if i > 0:
+                yield ','
+            yield from _iter_json(value)
+        yield ']'
+    elif obj is None or isinstance(obj, (str, int, float)):
+        yield json.dumps(obj, ensure_ascii=False)
+    else:
+        # dates and other types that flask knows how to serialize
+        yield flask_json.dumps(obj)
+
+
+def dumps_raw(obj):
+    """Same as json.dumps(obj) but RawJSON values are not re-encoded."""
+    return ''.join(_iter_json(obj))
+
+
+def jsonify_raw(**kwargs):
+    """Same as flask.jsonify(**kwargs) but RawJSON values are not parsed
+    and re-encoded.
+    """
+    return Response(dumps_raw(kwargs), mimetype='application/json')
+
+
+def stream_jsonify_raw(**kwargs):
+    """Same as jsonify_raw() but the response is sent by chunks while
+    iterators among the values (e.g. iterate_borders()) are being consumed.
+    """
+    def generate_chunks(chunk_size=64*1024):
+        chunk = []
+        length = 0
+        for piece in _iter_json(kwargs):
+            chunk.append(piece)
+            length += len(piece)
+            if length >= chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+                length = 0
+        if chunk:
+            yield ''.join(chunk)
+
+    return Response(stream_with_context(generate_chunks()),
+                    mimetype='application/json')
+
+
+# Simplification tolerances for which the borders table stores
+# simplified geometries, see db/create_tables.sql
+SIMPLIFIED_GEOM_COLUMNS = {
+    0.01: 'geom_simple1',
+    0.1: 'geom_simple2',
+}
+
+
+def border_properties_sql(a_borders_table):
+    """Returns SQL expressions for nodes count, area in square meters
+    and admin_level of a border from the table aliased as 't'
+    and for admin_level of its parent from the table aliased as 'p'.
+    The main table stores them in columns, see db/create_tables.sql.
+    """
+    if a_borders_table == borders_table:
+        return {
+            'nodes': 't.npoints',
+            'area': 't.area_km2 * 1E6',
+            'admin_level': 't.admin_level',
+            'parent_admin_level': 'p.admin_level',
+        }
+    return {
+        'nodes': 'ST_NPoints(t.geom)',
+        'area': 'ST_Area(geography(t.geom))',
+        'admin_level': f"""(SELECT admin_level FROM {osm_table}
+                            WHERE osm_id = t.id)""",
+        'parent_admin_level': f"""(SELECT admin_level FROM {osm_table}
+                                   WHERE osm_id = p.id)""",
+    }
+
+
 def geom_intersects_bbox_sql(xmin, ymin, xmax, ymax):
     return (f'(geom && ST_MakeBox2D(ST_Point({xmin}, {ymin}),'
                                   f'ST_Point({xmax}, {ymax})))')
 
 
 def fetch_borders(**kwargs):
+    """Returns the list of GeoJSON features. If 'raw_geometry' argument
+    is True, geometries are RawJSON strings to be passed to jsonify_raw().
+    """
+    return list(iterate_borders(**kwargs))
+
+
+def iterate_borders(**kwargs):
+    """Yields GeoJSON features like fetch_borders() does, reading them
+    from a server-side cursor by FETCH_BORDERS_CHUNK_SIZE rows.
+    """
     a_borders_table = kwargs.get('table', borders_table)
+    raw_geometry = kwargs.get('raw_geometry', False)
     simplify = kwargs.get('simplify', 0)
     where_clause = kwargs.get('where_clause', '1=1')
     only_leaves = kwargs.get('only_leaves', True)
-    geom = (f'ST_SimplifyPreserveTopology(geom, {simplify})'
-            if simplify > 0 else 'geom')
+    if simplify <= 0:
+        geom = 'geom'
+    elif (a_borders_table == borders_table and
+            simplify in SIMPLIFIED_GEOM_COLUMNS):
+        geom = SIMPLIFIED_GEOM_COLUMNS[simplify]
+    else:
+        geom = f'ST_SimplifyPreserveTopology(geom, {simplify})'
     leaves_filter = (f""" AND id NOT IN (SELECT parent_id FROM {a_borders_table}
                                           WHERE parent_id IS NOT NULL)"""
                      if only_leaves else '')
+    props_sql = border_properties_sql(a_borders_table)
     query = f"""
-        SELECT name, geometry, nodes, modified, disabled, count_k, cmnt,
-               (CASE WHEN area = 'NaN'::DOUBLE PRECISION THEN 0 ELSE area END) AS area,
-               id, admin_level, parent_id, parent_name, parent_admin_level,
-               mwm_size_est
+        SELECT q.name,
+               ST_AsGeoJSON(q.geometry, 7),
+               q.nodes, q.modified, q.disabled, q.count_k, q.cmnt,
+               q.area, q.id, q.admin_level, q.parent_id,
+               p.name AS parent_name,
+               {props_sql['parent_admin_level']} AS parent_admin_level,
+               q.mwm_size_est
         FROM (
             SELECT name,
-               ST_AsGeoJSON({geom}, 7) as geometry,
-               ST_NPoints(geom) AS nodes,
+               {geom} AS geometry,
+               {props_sql['nodes']} AS nodes,
                modified,
                disabled,
                count_k,
                cmnt,
-               round(ST_Area(geography(geom))) AS area,
+               (CASE WHEN {props_sql['area']} = 'NaN'::DOUBLE PRECISION
+                     THEN 0
+                     ELSE round({props_sql['area']})
+                END) AS area,
                id,
-               ( SELECT admin_level FROM {osm_table}
-                 WHERE osm_id = t.id
-               ) AS admin_level,
+               {props_sql['admin_level']} AS admin_level,
                parent_id,
-               ( SELECT name FROM {a_borders_table}
-                 WHERE id = t.parent_id
-               ) AS parent_name,
-               ( SELECT admin_level FROM {osm_table}
-                 WHERE osm_id = (SELECT parent_id FROM {a_borders_table} WHERE id = t.id)
-               ) AS parent_admin_level,
                mwm_size_est
             FROM {a_borders_table} t
             WHERE ({where_clause}) {leaves_filter}
         ) q
+            LEFT JOIN {a_borders_table} p ON p.id = q.parent_id
         ORDER BY area DESC
         """
-    with g.conn.cursor() as cursor:
+    hierarchy = get_region_hierarchy(g.conn)
+    with g.conn.cursor(name='iterate_borders') as cursor:
         cursor.execute(query)
-        borders = []
-        for rec in cursor:
-            region_id = rec[8]
-            country_id, country_name = get_region_country(g.conn, region_id)
-            props = { 'name': rec[0] or '', 'nodes': rec[2], 'modified': rec[3],
-                      'disabled': rec[4], 'count_k': rec[5],
-                      'comment': rec[6],
-                      'area': rec[7],
-                      'id': region_id,
-                      'admin_level': rec[9],
-                      'parent_id': rec[10],
-                      'parent_name': rec[11],
-                      'parent_admin_level': rec[12],
-                      'country_id': country_id,
-                      'country_name': country_name,
-                      'mwm_size_est': rec[13]
-                    }
-            feature = {'type': 'Feature',
-                       'geometry': json.loads(rec[1]),
-                       'properties': props
-                      }
-            borders.append(feature)
-    return borders
+        while True:
+            records = cursor.fetchmany(FETCH_BORDERS_CHUNK_SIZE)
+            if not records:
+                break
+            for rec in records:
+                yield _make_border_feature(rec, hierarchy, raw_geometry)
+
+
+def _make_border_feature(rec, hierarchy, raw_geometry):
+    region_id = rec[8]
+    # The uppermost predecessor of the region is its country
+    country_id, country_name = (
+        hierarchy.get_predecessors(region_id)[-1] if region_id in hierarchy
+        else (None, None)
+    )
+    props = { 'name': rec[0] or '', 'nodes': rec[2], 'modified': rec[3],
+              'disabled': rec[4], 'count_k': rec[5],
+              'comment': rec[6],
+              'area': rec[7],
+              'id': region_id,
+              'admin_level': rec[9],
+              'parent_id': rec[10],
+              'parent_name': rec[11],
+              'parent_admin_level': rec[12],
+              'country_id': country_id,
+              'country_name': country_name,
+              'mwm_size_est': rec[13]
+            }
+    feature = {'type': 'Feature',
+               'geometry': (RawJSON(rec[1]) if raw_geometry
+                            else json.loads(rec[1])),
+               'properties': props
+              }
+    return feature
 
 
 def simplify_level_to_postgis_value(simplify_level):
@@ -99,21 +232,139 @@ def simplify_level_to_postgis_value(simplify_level):
     )
 
 
-def get_subregions_for_preview(region_ids, next_level):
+# Half of the Web Mercator world width in meters
+MERCATOR_WORLD = 20037508.342789244
+
+
+def tile_bounds(z, x, y, margin=0.0):
+    """Returns (xmin, ymin, xmax, ymax) of the tile in Web Mercator meters,
+    extended by the 'margin' which is a share of the tile size.
+    """
+    tile_size = 2 * MERCATOR_WORLD / 2**z
+    xmin = -MERCATOR_WORLD + x * tile_size
+    ymax = MERCATOR_WORLD - y * tile_size
+    return (xmin - margin * tile_size,
+            ymax - tile_size - margin * tile_size,
+            xmin + tile_size + margin * tile_size,
+            ymax + margin * tile_size)
+
+
+def mercator_to_lonlat(mx, my):
+    lon = mx / MERCATOR_WORLD * 180
+    lat = math.degrees(2 * math.atan(math.exp(my / MERCATOR_WORLD * math.pi))
+                       - math.pi / 2)
+    return lon, lat
+
+
+def fetch_borders_tile(z, x, y, **kwargs):
+    """Returns Mapbox vector tile with borders as bytes.
+    Border properties are the same as in fetch_borders().
+    """
+    a_borders_table = kwargs.get('table', borders_table)
+    layer = kwargs.get('layer', 'borders')
+    only_leaves = kwargs.get('only_leaves', True)
+    leaves_filter = (f""" AND id NOT IN (SELECT parent_id FROM {a_borders_table}
+                                          WHERE parent_id IS NOT NULL)"""
+                     if only_leaves else '')
+    tile_box = tile_bounds(z, x, y)
+    # Clip geometries in degrees before transformation to Web Mercator,
+    # with a margin to not produce false edges inside the tile buffer.
+    xmin, ymin, xmax, ymax = tile_bounds(z, x, y, margin=2*MVT_BUFFER/MVT_EXTENT)
+    lon_min, lat_min = mercator_to_lonlat(max(xmin, -MERCATOR_WORLD),
+                                          max(ymin, -MERCATOR_WORLD))
+    lon_max, lat_max = mercator_to_lonlat(min(xmax, MERCATOR_WORLD),
+                                          min(ymax, MERCATOR_WORLD))
+    props_sql = border_properties_sql(a_borders_table)
+    # Simplification finer than a pixel of the tile cannot be seen
+    tolerance = (tile_box[2] - tile_box[0]) / MVT_EXTENT
+    params = {
+        'lon_min': lon_min, 'lat_min': lat_min,
+        'lon_max': lon_max, 'lat_max': lat_max,
+        'tile_xmin': tile_box[0], 'tile_ymin': tile_box[1],
+        'tile_xmax': tile_box[2], 'tile_ymax': tile_box[3],
+        'tolerance': tolerance,
+        'layer': layer,
+    }
+    query = f"""
+        WITH RECURSIVE tile_borders AS (
+            SELECT *
+            FROM {a_borders_table}
+            WHERE geom && ST_MakeEnvelope(%(lon_min)s, %(lat_min)s,
+                                          %(lon_max)s, %(lat_max)s, 4326)
+                  {leaves_filter}
+        ), chain(region_id, id, name, parent_id) AS (
+            SELECT id, id, name, parent_id
+            FROM tile_borders
+          UNION ALL
+            SELECT c.region_id, b.id, b.name, b.parent_id
+            FROM chain c JOIN {borders_table} b ON b.id = c.parent_id
+        ), countries AS (
+            SELECT region_id, id AS country_id, name AS country_name
+            FROM chain
+            WHERE parent_id IS NULL
+        ), features AS (
+            SELECT
+               ST_AsMVTGeom(
+                   ST_SimplifyPreserveTopology(
+                       ST_Transform(
+                           ST_ClipByBox2D(
+                               t.geom,
+                               ST_MakeEnvelope(%(lon_min)s, %(lat_min)s,
+                                               %(lon_max)s, %(lat_max)s, 4326)
+                           ),
+                           3857
+                       ),
+                       %(tolerance)s
+                   ),
+                   ST_MakeBox2D(ST_Point(%(tile_xmin)s, %(tile_ymin)s),
+                                ST_Point(%(tile_xmax)s, %(tile_ymax)s)),
+                   {MVT_EXTENT}, {MVT_BUFFER}, true
+               ) AS geom,
+               coalesce(t.name, '') AS name,
+               {props_sql['nodes']} AS nodes,
+               t.modified::text AS modified,
+               t.disabled,
+               t.count_k,
+               t.cmnt AS comment,
+               (CASE WHEN {props_sql['area']} = 'NaN'::DOUBLE PRECISION
+                     THEN 0
+                     ELSE round({props_sql['area']})
+                END) AS area,
+               t.id,
+               {props_sql['admin_level']} AS admin_level,
+               t.parent_id,
+               p.name AS parent_name,
+               {props_sql['parent_admin_level']} AS parent_admin_level,
+               c.country_id,
+               c.country_name,
+               t.mwm_size_est
+            FROM tile_borders t
+                LEFT JOIN {a_borders_table} p ON p.id = t.parent_id
+                LEFT JOIN countries c ON c.region_id = t.id
+        )
+        SELECT ST_AsMVT(features, %(layer)s, {MVT_EXTENT}, 'geom')
+        FROM features
+        WHERE geom IS NOT NULL
+        """
+    with g.conn.cursor() as cursor:
+        cursor.execute(query, params)
+        tile = cursor.fetchone()[0]
+    return bytes(tile) if tile is not None else b''
+
+
+def get_subregions_for_preview(conn, region_ids, next_level):
     subregions = list(itertools.chain.from_iterable(
-        get_subregions_one_for_preview(region_id, next_level)
+        get_subregions_one_for_preview(conn, region_id, next_level)
             for region_id in region_ids
     ))
     return subregions
 
 
-def get_subregions_one_for_preview(region_id, next_level):
-    with g.conn.cursor() as cursor:
-        # We use ST_SimplifyPreserveTopology, since ST_Simplify would give NULL
-        # for very little regions.
+def get_subregions_one_for_preview(conn, region_id, next_level):
+    with conn.cursor() as cursor:
         cursor.execute(f"""
             SELECT name,
-                   ST_AsGeoJSON(ST_SimplifyPreserveTopology(way, 0.01)) as way,
+                   ST_AsGeoJSON(way_simple1) as way,
                    osm_id
             FROM {osm_table}
             WHERE ST_Contains(
@@ -124,39 +375,79 @@ def get_subregions_one_for_preview(region_id, next_level):
         )
         subregions = []
         for rec in cursor:
-            feature = {'type': 'Feature', 'geometry': json.loads(rec[1]),
+            feature = {'type': 'Feature', 'geometry': RawJSON(rec[1]),
                        'properties': {'name': rec[0]}}
             subregions.append(feature)
     return subregions
 
 
-def get_clusters_for_preview(region_ids, next_level, thresholds):
-    clusters = list(itertools.chain.from_iterable(
-        get_clusters_for_preview_one(region_id, next_level, thresholds)
-            for region_id in region_ids
-    ))
+def split_regions_without_splitting(conn, region_ids, next_level, mwm_size_thr,
+                                    progress=None):
+    """Auto-splits in parallel those regions that have no stored splitting
+    with given parameters yet. Commits 'conn'. 'progress' is passed
+    to split_regions(). Returns the number of regions split.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT DISTINCT osm_border_id FROM {autosplit_table}
+            WHERE osm_border_id = ANY(%s)
+              AND mwm_size_thr = %s
+              AND next_level = %s
+            """, (list(region_ids), mwm_size_thr, next_level)
+        )
+        split_region_ids = set(rec[0] for rec in cursor)
+    region_ids_to_split = [x for x in region_ids if x not in split_region_ids]
+    split_regions(conn, region_ids_to_split, next_level, mwm_size_thr,
+                  progress)
+    return len(region_ids_to_split)
+
+
+def _split_stage_progress(progress, region_count):
+    """Progress of splitting for operations that afterwards process
+    'region_count' regions, so that the total covers both stages.
+    """
+    if not progress:
+        return None
+    return lambda done, total: progress(done, total + region_count)
+
+
+def get_clusters_for_preview(conn, region_ids, next_level, thresholds,
+                             progress=None):
+    split_count = 0
+    if len(region_ids) > 1:
+        split_count = split_regions_without_splitting(
+            conn, region_ids, next_level, thresholds,
+            _split_stage_progress(progress, len(region_ids))
+        )
+    clusters = []
+    for i, region_id in enumerate(region_ids):
+        clusters.extend(
+            get_clusters_for_preview_one(conn, region_id, next_level, thresholds)
+        )
+        if progress:
+            progress(split_count + i + 1, split_count + len(region_ids))
     return clusters
 
 
-def get_clusters_for_preview_one(region_id, next_level, mwm_size_thr):
+def get_clusters_for_preview_one(conn, region_id, next_level, mwm_size_thr):
     where_clause = f"""
         osm_border_id = %s
         AND mwm_size_thr = %s
         AND next_level = %s
         """
     splitting_sql_params = (region_id, mwm_size_thr, next_level)
-    with g.conn.cursor() as cursor:
+    with conn.cursor() as cursor:
         cursor.execute(f"""
             SELECT 1 FROM {autosplit_table}
             WHERE {where_clause}
             """, splitting_sql_params
         )
         if cursor.rowcount == 0:
-            split_region(g.conn, region_id, next_level, mwm_size_thr)
+            split_region(conn, region_id, next_level, mwm_size_thr)
 
         cursor.execute(f"""
             SELECT subregion_ids[1],
-                   ST_AsGeoJSON(ST_SimplifyPreserveTopology(geom, 0.01)) as way
+                   ST_AsGeoJSON(geom_simple1) as way
             FROM {autosplit_table}
             WHERE {where_clause}
             """, splitting_sql_params
@@ -165,36 +456,57 @@ def get_clusters_for_preview_one(region_id, next_level, mwm_size_thr):
         for rec in cursor:
             cluster = {
                 'type': 'Feature',
-                'geometry': json.loads(rec[1]),
+                'geometry': RawJSON(rec[1]),
                 'properties': {'osm_id': int(rec[0])}
             }
             clusters.append(cluster)
     return clusters
 
 
-def divide_into_subregions_preview(region_ids, next_level):
-    subregions = get_subregions_for_preview(region_ids, next_level)
-    return jsonify(
-        status='ok',
-        subregions={'type': 'FeatureCollection', 'features': subregions}
-    )
-
-
-def divide_into_clusters_preview(region_ids, next_level, mwm_size_thr):
-    subregions = get_subregions_for_preview(region_ids, next_level)
-    clusters = get_clusters_for_preview(region_ids, next_level, mwm_size_thr)
-    return jsonify(
-        status='ok',
-        subregions={'type': 'FeatureCollection', 'features': subregions},
-        clusters={'type': 'FeatureCollection', 'features': clusters}
-    )
-
-
-def divide_into_subregions(region_ids, next_level):
-    for region_id in region_ids:
-        divide_region_into_subregions(g.conn, region_id, next_level)
-    g.conn.commit()
-    return jsonify(status='ok')
+def divide_regions(conn, region_ids, next_level, mwm_size_thr=None,
+                   preview=False, progress=None):
+    """Divides regions into subregions of next_level, or into clusters
+    of them if mwm_size_thr is given. Returns the dict of values
+    for the response. 'progress', if given, is called as
+    progress(done, total) after each region.
+    """
+    if mwm_size_thr is not None:
+        if preview:
+            return divide_into_clusters_preview(conn, region_ids, next_level,
+                                                mwm_size_thr, progress)
+        return divide_into_clusters(conn, region_ids, next_level,
+                                    mwm_size_thr, progress)
+    else:
+        if preview:
+            return divide_into_subregions_preview(conn, region_ids, next_level)
+        return divide_into_subregions(conn, region_ids, next_level, progress)
+
+
+def divide_into_subregions_preview(conn, region_ids, next_level):
+    subregions = get_subregions_for_preview(conn, region_ids, next_level)
+    return {
+        'subregions': {'type': 'FeatureCollection', 'features': subregions}
+    }
+
+
+def divide_into_clusters_preview(conn, region_ids, next_level, mwm_size_thr,
+                                 progress=None):
+    subregions = get_subregions_for_preview(conn, region_ids, next_level)
+    clusters = get_clusters_for_preview(conn, region_ids, next_level,
+                                        mwm_size_thr, progress)
+    return {
+        'subregions': {'type': 'FeatureCollection', 'features': subregions},
+        'clusters': {'type': 'FeatureCollection', 'features': clusters}
+    }
+
+
+def divide_into_subregions(conn, region_ids, next_level, progress=None):
+    for i, region_id in enumerate(region_ids):
+        divide_region_into_subregions(conn, region_id, next_level)
+        if progress:
+            progress(i + 1, len(region_ids))
+    conn.commit()
+    return {}
 
 
 def divide_region_into_subregions(conn, region_id, next_level):
@@ -239,10 +551,17 @@ def divide_region_into_subregions(conn, region_id, next_level):
         return ids_to_insert
 
 
-def divide_into_clusters(region_ids, next_level, mwm_size_thr):
-    cursor = g.conn.cursor()
-    insert_cursor = g.conn.cursor()
-    for region_id in region_ids:
+def divide_into_clusters(conn, region_ids, next_level, mwm_size_thr,
+                         progress=None):
+    split_count = 0
+    if len(region_ids) > 1:
+        split_count = split_regions_without_splitting(
+            conn, region_ids, next_level, mwm_size_thr,
+            _split_stage_progress(progress, len(region_ids))
+        )
+    cursor = conn.cursor()
+    insert_cursor = conn.cursor()
+    for i, region_id in enumerate(region_ids):
         cursor.execute(f"SELECT name FROM {borders_table} WHERE id = %s", (region_id,))
         base_name = cursor.fetchone()[0]
 
@@ -258,9 +577,9 @@ def divide_into_clusters(region_ids, next_level, mwm_size_thr):
             """, splitting_sql_params
         )
         if cursor.rowcount == 0:
-            split_region(g.conn, region_id, next_level, mwm_size_thr)
+            split_region(conn, region_id, next_level, mwm_size_thr)
 
-        free_id = get_free_id()
+        free_id = get_free_id(conn)
         counter = 0
         cursor.execute(f"""
             SELECT subregion_ids
@@ -282,7 +601,7 @@ def divide_into_clusters(region_ids, next_level, mwm_size_thr):
                 cluster_id = subregion_ids[0]
                 if len(subregion_ids) == 1:
                     subregion_id = cluster_id
-                    name = get_osm_border_name_by_osm_id(g.conn, subregion_id)
+                    name = get_osm_border_name_by_osm_id(conn, subregion_id)
                 else:
                     counter += 1
                     free_id -= 1
@@ -294,12 +613,40 @@ def divide_into_clusters(region_ids, next_level, mwm_size_thr):
                     FROM {autosplit_table} WHERE subregion_ids[1] = %s AND {where_clause}
                     """, (name, cluster_id,) + splitting_sql_params
                 )
-    g.conn.commit()
-    return jsonify(status='ok')
+        if progress:
+            progress(split_count + i + 1, split_count + len(region_ids))
+    conn.commit()
+    return {}
 
 
-def get_free_id():
-    with g.conn.cursor() as cursor:
+def make_backup(conn):
+    """Copies the borders table into the backup table with the current
+    time as the backup name. Returns False if a backup with the same name
+    already exists.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT to_char(now(), 'IYYY-MM-DD HH24:MI'), max(backup)
+            FROM {backup_table}
+            """)
+        (timestamp, tsmax) = cursor.fetchone()
+        if timestamp == tsmax:
+            return False
+        cursor.execute(f"""
+            INSERT INTO {backup_table}
+                 (backup, id, name, parent_id, geom, disabled, count_k,
+                    modified, cmnt, mwm_size_est)
+              SELECT %s, id, name, parent_id, geom, disabled, count_k,
+                    modified, cmnt, mwm_size_est
+              FROM {borders_table}
+            """, (timestamp,)
+        )
+    conn.commit()
+    return True
+
+
+def get_free_id(conn):
+    with conn.cursor() as cursor:
         cursor.execute(f"SELECT min(id) FROM {borders_table} WHERE id < -1000000000")
         min_id = cursor.fetchone()[0]
     free_id = min_id - 1 if min_id else -1_000_000_001
@@ -328,7 +675,7 @@ def create_or_update_region(region, free_id):
     with g.conn.cursor() as cursor:
         if region['id'] < 0:
             if not free_id:
-                free_id = get_free_id()
+                free_id = get_free_id(g.conn)
             region_id = free_id
 
             cursor.execute(f"""
@@ -367,15 +714,15 @@ def find_potential_parents(region_id):
         SELECT
           p.id,
           p.name,
-          (SELECT admin_level FROM {osm_table} WHERE osm_id = p.id) admin_level,
-          ST_AsGeoJSON(ST_SimplifyPreserveTopology(p.geom, 0.01)) geometry
+          p.admin_level,
+          ST_AsGeoJSON(p.geom_simple1) geometry
         FROM {borders_table} p, {borders_table} c
         WHERE c.id = %s
             AND ST_Intersects(p.geom, c.geom)
-            AND ST_Area({p_geogr}) > ST_Area({c_geogr})
+            AND p.area_km2 > c.area_km2
             AND ST_Area(ST_Intersection({p_geogr}, {c_geogr})) >
-                    0.5 * ST_Area({c_geogr})
-        ORDER BY ST_Area({p_geogr})
+                    0.5 * c.area_km2 * 1E6
+        ORDER BY p.area_km2
     """
     with g.conn.cursor() as cursor:
         cursor.execute(query, (region_id,))
@@ -388,14 +735,19 @@ def find_potential_parents(region_id):
             }
             feature = {
                     'type': 'Feature',
-                    'geometry': json.loads(rec[3]),
+                    'geometry': RawJSON(rec[3]),
                     'properties': props
             }
             parents.append(feature)
     return parents
 
 
-def copy_region_from_osm(conn, region_id, name=None, parent_id='not_passed'):
+def copy_region_from_osm(conn, region_id, name=None, parent_id='not_passed',
+                         estimate_mwm_size=True):
+    """Copies the border from the OSM table. Callers copying many borders
+    pass estimate_mwm_size=False and estimate them all at once
+    with update_borders_mwm_size_estimation(). Doesn't commit.
+    """
     errors, warnings = [], []
     with conn.cursor() as cursor:
         # Check if this id already in use
@@ -418,10 +770,8 @@ def copy_region_from_osm(conn, region_id, name=None, parent_id='not_passed'):
         )
         if parent_id == 'not_passed':
             assign_region_to_lowest_parent(conn, region_id)
-        try:
-            update_border_mwm_size_estimation(conn, region_id)
-        except Exception as e:
-            warnings.append(str(e))
+        if estimate_mwm_size:
+            warnings = update_borders_mwm_size_estimation(conn, [region_id])
         return errors, warnings
 
 
@@ -6,6 +6,7 @@ import time
 import psycopg2
 
 import config
+from jobs import reset_interrupted_jobs, run_next_job
 
 try:
     from daemon import runner
@@ -30,7 +31,7 @@ no_count_queries = [
         SELECT id, name
         FROM (
             SELECT id, name,
-            ST_Area(geography(geom))/1000000.0 area,
+            area_km2 area,
             ST_Area(geography(ST_Envelope(geom)))/1000000.0 env_area
             FROM {borders_table}
             WHERE {condition}) q
@@ -50,6 +51,7 @@ class App():
         self.pidfile_path = config.DAEMON_PID_PATH
         self.pidfile_timeout = 5
         self.conn = None
+        self.job_conn = None
 
     def get_connection(self):
         while True:
@@ -69,6 +71,12 @@ class App():
                    pass
                 time.sleep(CONNECT_WAIT_INTERVAL)
 
+    def get_job_connection(self):
+        """Returns the connection for jobs, which commit by themselves"""
+        if self.job_conn is None or self.job_conn.closed:
+            self.job_conn = psycopg2.connect(config.CONNECTION)
+        return self.job_conn
+
     def process(self, region_id, region_name):
         msg = f'Processing {region_name} ({region_id})'
         logger.info(msg)
@@ -108,8 +116,16 @@ class App():
         return res if res else (None, None)
 
     def run(self):
+        # Jobs of a previous daemon run that has been killed
+        # would stay running forever
+        for job_id in reset_interrupted_jobs(self.get_connection()):
+            logger.warning(f"Job {job_id} has been interrupted")
         while True:
             try:
+                # Jobs are requested by users, so they go first
+                if run_next_job(self.get_job_connection(),
+                                self.get_connection()):
+                    continue
                 region_id, region_name = self.find_region()
                 if region_id:
                     self.process(region_id, region_name)
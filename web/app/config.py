@@ -1,5 +1,13 @@
 # postgresql connection string
 CONNECTION = 'dbname=borders user=borders password=borders host=dbhost port=5432'
+# max number of connections kept by each web server worker process
+DB_POOL_MAX_SIZE = 10
+# seconds to wait for a free connection if all of them are in use
+DB_POOL_TIMEOUT = 30
+# connections are reopened after so many seconds
+DB_POOL_MAX_LIFETIME = 3600
+# connections idle for so many seconds are checked before use
+DB_POOL_HEALTH_CHECK_INTERVAL = 30
 # passed to flask.Debug
 DEBUG = True
 # if the main table is read-only
@@ -10,6 +18,13 @@ BORDERS_TABLE = 'borders'
 OSM_TABLE = 'osm_borders'
 # All populated places in OSM
 OSM_PLACES_TABLE = 'osm_places'
+# sequence advanced by a trigger on each change of the region hierarchy
+# in the main table
+HIERARCHY_VERSION_SEQUENCE = 'borders_hierarchy_version_seq'
+# cache of common border lengths of osm borders
+OSM_ADJACENCY_TABLE = 'osm_borders_adjacency'
+# ids of osm borders whose adjacency is cached
+OSM_ADJACENCY_CALCULATED_TABLE = 'osm_borders_adjacency_calculated'
 # transit table for autosplitting results
 AUTOSPLIT_TABLE = 'splitting'
 # tables with borders for reference
@@ -18,10 +33,24 @@ OTHER_TABLES = {
 }
 # backup table
 BACKUP = 'borders_backup'
+# queue of long-running operations
+JOBS_TABLE = 'jobs'
+# number of borders fetched from the database at once while streaming
+FETCH_BORDERS_CHUNK_SIZE = 100
 # area of an island for it to be considered small
 SMALL_KM2 = 10
+# extent and buffer of Mapbox vector tiles with borders, in tile pixels
+MVT_EXTENT = 4096
+MVT_BUFFER = 64
+# seconds for which browsers may cache the vector tiles
+MVT_CACHE_MAX_AGE = 60
+# max number of regions returned by /search_suggest
+SEARCH_SUGGESTIONS_LIMIT = 10
 # force multipolygons in JOSM output
 JOSM_FORCE_MULTI = True
+# split borders at junctions in JOSM output so that common parts
+# of neighbour borders are exported once; /josm?topology= overrides it
+JOSM_TOPOLOGY = False
 # alert instead of json on import error
 IMPORT_ERROR_ALERT = False
 # file to which daemon writes the name of currently processed region
@@ -30,6 +59,11 @@ DAEMON_PID_PATH = '/tmp/borders-daemon.pid'
 DAEMON_LOG_PATH = '/var/log/borders-daemon.log'
 # mwm size threshold in Kb
 MWM_SIZE_THRESHOLD = 70*1024
+# number of parallel database sessions of mwm_size_reestimation.py
+MWM_REESTIMATION_WORKERS = 4
+# max number of regions auto-split concurrently by one request,
+# limited by connections free in the pool
+AUTOSPLIT_WORKERS = 4
 # Estimated mwm size is predicted by the 'model.pkl' with 'scaler.pkl' for X
 MWM_SIZE_PREDICTION_MODEL_PATH = '/app/data/model.pkl'
 MWM_SIZE_PREDICTION_MODEL_SCALER_PATH = '/app/data/scaler.pkl'
@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+import config
+
+
+class ConnectionPoolException(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Bounded pool of psycopg2 connections.
+
+    Connections are checked with a trivial query if they stayed idle
+    for longer than 'health_check_interval' seconds and are replaced
+    when they live longer than 'max_lifetime' seconds.
+    """
+
+    def __init__(self, dsn, max_size, timeout,
+                 max_lifetime, health_check_interval):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self._idle = deque()  # (conn, created_at, released_at)
+        self._created_at = {}  # conn => creation time, for all open conns
+        self._size = 0  # open connections plus connections being opened
+        self._cond = threading.Condition()
+        self.stats = {
+            'requests': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'connections_opened': 0,
+            'connections_closed': 0,
+            'health_check_failures': 0,
+            'recycled': 0,
+        }
+
+    def getconn(self, timeout=None):
+        """Returns a connection, waiting for a free one at most 'timeout'
+        seconds (the pool timeout by default, 0 for no waiting).
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.stats['requests'] += 1
+            while not self._idle and self._size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise ConnectionPoolException(
+                        f"No free connection in the pool after "
+                        f"{timeout} seconds"
+                    )
+                self.stats['waits'] += 1
+                self._cond.wait(remaining)
+            if self._idle:
+                conn, created_at, released_at = self._idle.pop()
+            else:
+                conn = None
+                self._size += 1
+
+        if conn is not None:
+            now = time.time()
+            if now - created_at > self.max_lifetime:
+                self._close(conn, reopen=True)
+                self.stats['recycled'] += 1
+                conn = None
+            elif (now - released_at > self.health_check_interval and
+                    not self._is_alive(conn)):
+                self._close(conn, reopen=True)
+                self.stats['health_check_failures'] += 1
+                conn = None
+        if conn is None:
+            conn = self._open()
+        return conn
+
+    def putconn(self, conn):
+        if conn.closed:
+            self._close(conn)
+            return
+        try:
+            # Uncommitted changes of the request must not leak
+            # into the next one.
+            if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if conn.autocommit:
+                conn.autocommit = False
+        except psycopg2.Error:
+            self._close(conn)
+            return
+        created_at = self._created_at[conn]
+        if time.time() - created_at > self.max_lifetime:
+            self.stats['recycled'] += 1
+            self._close(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, created_at, time.time()))
+            self._cond.notify()
+
+    def get_stats(self):
+        with self._cond:
+            idle = len(self._idle)
+            stats = dict(self.stats,
+                         size=self._size,
+                         idle=idle,
+                         in_use=self._size - idle,
+                         max_size=self.max_size)
+        return stats
+
+    def _open(self):
+        """Opens a connection for the slot already reserved in self._size"""
+        try:
+            conn = psycopg2.connect(self.dsn)
+        except psycopg2.Error:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        self._created_at[conn] = time.time()
+        self.stats['connections_opened'] += 1
+        return conn
+
+    def _close(self, conn, reopen=False):
+        """Closes the connection. If 'reopen' is True, the slot of
+        the connection stays reserved for the connection to be opened.
+        """
+        self._created_at.pop(conn, None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        self.stats['connections_closed'] += 1
+        if not reopen:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Returns the pool of the current process. uWSGI forks workers after
+    the application is loaded, so connections are never shared between
+    processes.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ConnectionPool(
+                config.CONNECTION,
+                max_size=config.DB_POOL_MAX_SIZE,
+                timeout=config.DB_POOL_TIMEOUT,
+                max_lifetime=config.DB_POOL_MAX_LIFETIME,
+                health_check_interval=config.DB_POOL_HEALTH_CHECK_INTERVAL
+            )
+            _pool_pid = os.getpid()
+        return _pool
@@ -4,10 +4,12 @@ from borders_api_utils import (
     get_osm_border_name_by_osm_id,
 )
 from config import (
+    AUTOSPLIT_TABLE as autosplit_table,
     BORDERS_TABLE as borders_table,
     OSM_TABLE as osm_table
 )
 from countries_division import country_initial_levels
+from subregions import update_borders_mwm_size_estimation
 
 
 class CountryStructureException(Exception):
@@ -22,7 +24,8 @@ def _clear_borders(conn):
 def _make_country_structure(conn, country_osm_id):
     country_name = get_osm_border_name_by_osm_id(conn, country_osm_id)
 
-    copy_region_from_osm(conn, country_osm_id, parent_id=None)
+    copy_region_from_osm(conn, country_osm_id, parent_id=None,
+                         estimate_mwm_size=False)
 
     if country_initial_levels.get(country_name):
         admin_levels = country_initial_levels[country_name]
@@ -48,12 +51,24 @@ def create_countries_initial_structure(conn):
             WHERE admin_level = 2
             """
         )
-        for country_osm_id, *_ in cursor:
-            _make_country_structure(conn, country_osm_id)
+        country_osm_ids = [rec[0] for rec in cursor]
+    for country_osm_id in country_osm_ids:
+        _make_country_structure(conn, country_osm_id)
+    update_borders_mwm_size_estimation(conn, country_osm_ids)
     conn.commit()
     return
 
 
+def recreate_countries_structure(conn):
+    """Replaces all borders by the initial structure of countries
+    and drops stored splittings.
+    """
+    create_countries_initial_structure(conn)
+    with conn.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {autosplit_table}")
+    conn.commit()
+
+
 def _get_country_osm_id_by_name(conn, name):
     with conn.cursor() as cursor:
         cursor.execute(f"""
@@ -0,0 +1,234 @@
+"""Queue of long-running operations stored in the jobs table.
+
+Web server enqueues jobs and borders_daemon.py executes them, so that
+heavy operations don't tie up web workers and don't hit proxy timeouts.
+"""
+import logging
+
+from borders_api_utils import (
+    divide_regions,
+    dumps_raw,
+    make_backup,
+)
+from config import JOBS_TABLE as jobs_table
+from countries_structure import recreate_countries_structure
+
+
+logger = logging.getLogger('borders-daemon')
+
+# First key of session advisory locks (JOBS_LOCK_KEY, job id) which
+# workers hold on running jobs. Jobs that are 'running' but not locked
+# have been interrupted by a worker crash.
+JOBS_LOCK_KEY = 0x6a6f6273
+
+
+class JobException(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobProgress:
+    """Callable progress(done, total) for long operations which stores
+    progress of the job and interrupts the job if it has been cancelled.
+    'status_conn' must be in autocommit mode for the progress to be visible
+    before the job transaction is committed.
+    """
+
+    def __init__(self, status_conn, job_id):
+        self.status_conn = status_conn
+        self.job_id = job_id
+
+    def __call__(self, done, total):
+        with self.status_conn.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {jobs_table}
+                SET progress = %s
+                WHERE id = %s
+                RETURNING cancel_requested
+                """, (done / total if total else 0, self.job_id)
+            )
+            rec = cursor.fetchone()
+        # A deleted job is not worth finishing either
+        if rec is None or rec[0]:
+            raise JobCancelled()
+
+
+def _run_divide(conn, params, progress):
+    return divide_regions(conn, progress=progress, **params)
+
+
+def _run_start_over(conn, params, progress):
+    recreate_countries_structure(conn)
+    return {}
+
+
+def _run_backup(conn, params, progress):
+    if not make_backup(conn):
+        raise JobException("please try again later")
+    return {}
+
+
+# job kind => function(conn, params, progress) returning the dict of results
+JOB_HANDLERS = {
+    'divide': _run_divide,
+    'start_over': _run_start_over,
+    'backup': _run_backup,
+}
+
+
+def enqueue_job(conn, kind, params):
+    """Adds the job to the queue and returns its id. Doesn't commit."""
+    assert kind in JOB_HANDLERS
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {jobs_table} (kind, params)
+            VALUES (%s, %s)
+            RETURNING id
+            """, (kind, dumps_raw(params))
+        )
+        return cursor.fetchone()[0]
+
+
+def get_job(conn, job_id):
+    """Returns the dict of job properties with serialized 'result',
+    or None if there is no such job.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT id, kind, status, progress, message,
+                   created, started, finished, result::text
+            FROM {jobs_table}
+            WHERE id = %s
+            """, (job_id,)
+        )
+        rec = cursor.fetchone()
+    if not rec:
+        return None
+    keys = ('id', 'kind', 'status', 'progress', 'message',
+            'created', 'started', 'finished', 'result')
+    return dict(zip(keys, rec))
+
+
+def cancel_job(conn, job_id):
+    """Cancels a queued job at once; a running job is interrupted at its
+    next progress report. Returns the new status of the job, or None if
+    the job is already finished or doesn't exist. Doesn't commit.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE {jobs_table}
+            SET cancel_requested = TRUE,
+                status = CASE WHEN status = 'queued' THEN 'cancelled'
+                              ELSE status END,
+                finished = CASE WHEN status = 'queued' THEN now()
+                                ELSE finished END
+            WHERE id = %s AND status IN ('queued', 'running')
+            RETURNING status
+            """, (job_id,)
+        )
+        rec = cursor.fetchone()
+    return rec[0] if rec else None
+
+
+def _take_job(status_conn):
+    """Marks the oldest queued job as running and returns (id, kind, params)
+    of it. Concurrent workers never take the same job. The job stays locked
+    by the session of 'status_conn' until _finish_job() is called.
+    """
+    with status_conn.cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE {jobs_table}
+            SET status = 'running', started = now()
+            WHERE id = (
+                SELECT id FROM {jobs_table}
+                WHERE status = 'queued'
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, kind, params, pg_advisory_lock({JOBS_LOCK_KEY}, id)
+            """
+        )
+        rec = cursor.fetchone()
+    return rec[:3] if rec else None
+
+
+def _finish_job(status_conn, job_id, status, message=None, result=None):
+    with status_conn.cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE {jobs_table}
+            SET status = %s,
+                message = %s,
+                result = %s,
+                progress = CASE WHEN %s = 'done' THEN 1 ELSE progress END,
+                finished = now()
+            WHERE id = %s
+            """, (status, message,
+                  dumps_raw(result) if result is not None else None,
+                  status, job_id)
+        )
+        cursor.execute(f"SELECT pg_advisory_unlock({JOBS_LOCK_KEY}, %s)",
+                       (job_id,))
+
+
+def reset_interrupted_jobs(status_conn):
+    """Marks as failed running jobs which no worker holds the lock on,
+    e.g. because the daemon has been killed. 'status_conn' must be
+    in autocommit mode. Returns the list of ids of such jobs.
+    """
+    with status_conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT id FROM {jobs_table}
+            WHERE status = 'running'
+            ORDER BY id
+            """
+        )
+        job_ids = [rec[0] for rec in cursor.fetchall()]
+        interrupted_ids = []
+        for job_id in job_ids:
+            cursor.execute(f"SELECT pg_try_advisory_lock({JOBS_LOCK_KEY}, %s)",
+                           (job_id,))
+            if not cursor.fetchone()[0]:
+                continue
+            cursor.execute(f"""
+                UPDATE {jobs_table}
+                SET status = 'failed',
+                    message = 'interrupted',
+                    finished = now()
+                WHERE id = %s AND status = 'running'
+                """, (job_id,)
+            )
+            if cursor.rowcount:
+                interrupted_ids.append(job_id)
+            cursor.execute(f"SELECT pg_advisory_unlock({JOBS_LOCK_KEY}, %s)",
+                           (job_id,))
+    return interrupted_ids
+
+
+def run_next_job(conn, status_conn):
+    """Executes the oldest queued job in 'conn'. Job status is written
+    through 'status_conn', which must be in autocommit mode.
+    Returns False if there were no queued jobs.
+    """
+    job = _take_job(status_conn)
+    if job is None:
+        return False
+    job_id, kind, params = job
+    logger.info(f"Running job {job_id} {kind} {params}")
+    try:
+        result = JOB_HANDLERS[kind](conn, params, JobProgress(status_conn, job_id))
+    except JobCancelled:
+        conn.rollback()
+        logger.info(f"Job {job_id} cancelled")
+        _finish_job(status_conn, job_id, 'cancelled')
+    except Exception as e:
+        conn.rollback()
+        logger.exception(f"Job {job_id} failed")
+        _finish_job(status_conn, job_id, 'failed', message=str(e))
+    else:
+        logger.info(f"Job {job_id} done")
+        _finish_job(status_conn, job_id, 'done', result=result)
+    return True
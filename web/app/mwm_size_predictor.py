@@ -8,11 +8,75 @@ class MwmSizePredictor:
 
     factors = ('urban_pop', 'area', 'city_cnt', 'hamlet_cnt',)
 
+    # Number of feature rows for which the kernel matrix
+    # is computed at once by the fast path
+    chunk_size = 4096
+
     def __init__(self):
         with open(config.MWM_SIZE_PREDICTION_MODEL_PATH, 'rb') as f:
             self.model = pickle.load(f)
         with open(config.MWM_SIZE_PREDICTION_MODEL_SCALER_PATH, 'rb') as f:
             self.scaler = pickle.load(f)
+        self._prepare_fast_path()
+
+    def _prepare_fast_path(self):
+        """Extracts parameters of SVR with RBF kernel and of StandardScaler
+        for prediction with plain NumPy. If the model or the scaler are
+        of some other kind, the sklearn path is used.
+        """
+        self.fast_path = False
+        model, scaler = self.model, self.scaler
+        if (getattr(model, 'kernel', None) != 'rbf' or
+                not hasattr(model, 'support_vectors_') or
+                not isinstance(model.support_vectors_, np.ndarray) or
+                model.dual_coef_.shape[0] != 1 or
+                not hasattr(scaler, 'mean_') or
+                not hasattr(scaler, 'scale_')):
+            return
+        n_features = model.support_vectors_.shape[1]
+        # StandardScaler.transform() ignores mean_ and scale_ which are
+        # turned off, though they may be set when fitting
+        if getattr(scaler, 'with_mean', True) and scaler.mean_ is not None:
+            mean = scaler.mean_
+        else:
+            mean = np.zeros(n_features)
+        if getattr(scaler, 'with_std', True) and scaler.scale_ is not None:
+            scale = scaler.scale_
+        else:
+            scale = np.ones(n_features)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        # Everything is computed in float64: terms of squared distances
+        # nearly cancel out and dual coefficients are large, so with float32
+        # predictions differ from sklearn ones by a few Kb and depend
+        # on the other rows of the batch.
+        self.support_vectors = np.asarray(model.support_vectors_,
+                                          dtype=np.float64)
+        self.support_vectors_sq_norms = np.einsum(
+            'ij,ij->i', self.support_vectors, self.support_vectors
+        )
+        self.dual_coef = np.asarray(model.dual_coef_[0], dtype=np.float64)
+        self.intercept = float(model.intercept_[0])
+        self.gamma = float(model._gamma)
+        self.fast_path = True
+
+    def _predict_fast(self, X):
+        X_scaled = (X - self.mean) / self.scale
+        predictions = np.empty(X_scaled.shape[0], dtype=np.float64)
+        for start in range(0, X_scaled.shape[0], self.chunk_size):
+            chunk = X_scaled[start:start + self.chunk_size]
+            # |x - sv|^2 = |x|^2 + |sv|^2 - 2 * x.sv
+            sq_distances = (
+                np.einsum('ij,ij->i', chunk, chunk)[:, np.newaxis]
+                + self.support_vectors_sq_norms
+                - 2 * (chunk @ self.support_vectors.T)
+            )
+            np.maximum(sq_distances, 0, out=sq_distances)
+            kernel = np.exp(-self.gamma * sq_distances)
+            predictions[start:start + self.chunk_size] = (
+                kernel @ self.dual_coef + self.intercept
+            )
+        return predictions
 
     @classmethod
     def _get_instance(cls):
@@ -26,14 +90,17 @@ class MwmSizePredictor:
         Each feature is a list of values for factors
         defined by 'cls.factors' sequence.
         """
-        X = np.array(features_array)
+        X = np.array(features_array, dtype=np.float64)
         one_prediction = (X.ndim == 1)
         if one_prediction:
             X = X.reshape(1, -1)
 
         predictor = cls._get_instance()
-        X_scaled = predictor.scaler.transform(X)
-        predictions = predictor.model.predict(X_scaled)
+        if predictor.fast_path:
+            predictions = predictor._predict_fast(X)
+        else:
+            X_scaled = predictor.scaler.transform(X)
+            predictions = predictor.model.predict(X_scaled)
         if one_prediction:
             return predictions[0]
         else:
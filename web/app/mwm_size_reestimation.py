@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+"""Re-estimates mwm size of all borders, e.g. after osm_places table update.
+
+Borders are partitioned by country, place aggregation for countries runs
+in parallel database sessions, and predictions for all borders are made
+with one call of the predictor.
+"""
+import argparse
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+
+import psycopg2
+
+import config
+from region_hierarchy import get_region_hierarchy
+from subregions import (
+    get_borders_estimation_data,
+    predict_mwm_size,
+    save_borders_mwm_size_estimation,
+)
+
+
+logger = logging.getLogger('mwm-size-reestimation')
+
+
+def get_border_ids_by_country(conn, country_ids=None):
+    """Returns dict {country_id => list of ids of all its borders}"""
+    hierarchy = get_region_hierarchy(conn)
+    border_ids_by_country = {}
+    for border_id in hierarchy.parents:
+        country_id = hierarchy.get_predecessors(border_id)[-1][0]
+        if country_ids and country_id not in country_ids:
+            continue
+        border_ids_by_country.setdefault(country_id, []).append(border_id)
+    return border_ids_by_country
+
+
+def get_country_estimation_data(border_ids):
+    with closing(psycopg2.connect(config.CONNECTION)) as conn:
+        return get_borders_estimation_data(conn, border_ids)
+
+
+def reestimate_mwm_sizes(conn, workers, country_ids=None):
+    start_time = time.time()
+    border_ids_by_country = get_border_ids_by_country(conn, country_ids)
+    countries_cnt = len(border_ids_by_country)
+    borders_cnt = sum(len(x) for x in border_ids_by_country.values())
+    logger.info(f"Re-estimating {borders_cnt} borders "
+                f"of {countries_cnt} countries with {workers} workers")
+
+    borders = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(get_country_estimation_data, border_ids): country_id
+                for country_id, border_ids in border_ids_by_country.items()
+        }
+        for i, future in enumerate(as_completed(futures), 1):
+            country_id = futures[future]
+            country_borders, warnings = future.result()
+            for warning in warnings:
+                logger.warning(warning)
+            borders.update(country_borders)
+            logger.info(f"[{i}/{countries_cnt}] Collected places for "
+                        f"{len(country_borders)} borders of {country_id}")
+
+    predict_mwm_size(borders)
+    save_borders_mwm_size_estimation(conn, borders)
+    conn.commit()
+    logger.info(f"Stored mwm size estimation for {len(borders)} borders "
+                f"in {time.time() - start_time:.1f} s")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-w', '--workers', type=int,
+                        default=config.MWM_REESTIMATION_WORKERS,
+                        help='number of parallel database sessions')
+    parser.add_argument('-c', '--country', type=int, action='append',
+                        dest='country_ids', metavar='COUNTRY_ID',
+                        help='re-estimate only borders of the country, '
+                             'may be repeated')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s [%(levelname)s] %(message)s")
+    args = parse_args()
+    with closing(psycopg2.connect(config.CONNECTION)) as conn:
+        reestimate_mwm_sizes(conn, args.workers, args.country_ids)
@@ -1,4 +1,7 @@
 import json
+import math
+from array import array
+from collections import defaultdict
 
 import config
 
@@ -30,6 +33,86 @@ def _ring_hash(refs):
     return hash(tuple(sorted(refs)))
 
 
+def _way_key(refs):
+    """Key for deduplication of ways: closed ways are equal if they have
+    the same nodes, open ones if they have the same nodes in the same
+    or reverse order.
+    """
+    if refs[0] == refs[-1]:
+        return _ring_hash(refs)
+    return min(tuple(refs), tuple(reversed(refs)))
+
+
+def _find_junctions(regions):
+    """Returns the set of nodes which don't have exactly two neighbour
+    nodes in all rings of the regions. Borders of neighbour regions
+    diverge at these nodes.
+    """
+    neighbours = {}  # node id => tuple of at most two neighbour node ids
+    junctions = set()
+
+    def add_neighbour(node, neighbour):
+        if node in junctions:
+            return
+        node_neighbours = neighbours.get(node, ())
+        if neighbour in node_neighbours:
+            return
+        if len(node_neighbours) == 2:
+            junctions.add(node)
+            del neighbours[node]
+        else:
+            neighbours[node] = node_neighbours + (neighbour,)
+
+    for region in regions:
+        for role, refs in region['rings']:
+            for node1, node2 in zip(refs, refs[1:]):
+                add_neighbour(node1, node2)
+                add_neighbour(node2, node1)
+    junctions.update(node for node, node_neighbours in neighbours.items()
+                        if len(node_neighbours) != 2)
+    return junctions
+
+
+def _split_ring(refs, junctions):
+    """Splits the closed ring into ways at junction nodes"""
+    positions = [i for i, nd in enumerate(refs[:-1]) if nd in junctions]
+    if not positions:
+        return [refs]
+    start = positions[0]
+    rotated = refs[start:-1] + refs[:start + 1]
+    ways = []
+    way_start = 0
+    for i in range(1, len(rotated)):
+        if rotated[i] in junctions:
+            ways.append(rotated[way_start:i + 1])
+            way_start = i
+    return ways
+
+
+class NodePool:
+    """Deduplicated nodes of exported geometries. Node ids are 1-based
+    indices in the coordinate arrays.
+    """
+
+    def __init__(self):
+        self.ids = {}  # (lat, lon) => node id
+        self.lats = array('d')
+        self.lons = array('d')
+
+    def get_id(self, lat, lon):
+        node_id = self.ids.get((lat, lon))
+        if node_id is None:
+            self.lats.append(lat)
+            self.lons.append(lon)
+            node_id = len(self.lats)
+            self.ids[(lat, lon)] = node_id
+        return node_id
+
+    def __iter__(self):
+        """Yields (node_id, lat, lon) tuples"""
+        return zip(range(1, len(self.lats) + 1), self.lats, self.lons)
+
+
 def _parse_polygon(node_pool, rings, polygon):
     role = 'outer'
     for ring in polygon:
@@ -38,34 +121,7 @@ def _parse_polygon(node_pool, rings, polygon):
 
 
 def _parse_linestring(node_pool, linestring):
-    nodes = []
-    for lonlat in linestring:
-        ref = f'{lonlat[1]} {lonlat[0]}'
-        if ref in node_pool:
-            node_id = node_pool[ref]
-        else:
-            node_id = node_pool['id']
-            node_pool[ref] = node_id
-            node_pool['id'] = node_id + 1
-        nodes.append(node_id)
-    return nodes
-
-
-def _append_way(way, way2):
-    another = list(way2) # make copy to not modify original list
-    if way[0] == way[-1] or another[0] == another[-1]:
-        return None
-    if way[0] == another[0] or way[-1] == another[-1]:
-        another.reverse()
-    if way[-1] == another[0]:
-        result = list(way)
-        result.extend(another[1:])
-        return result
-    elif way[0] == another[-1]:
-        result = another
-        result.extend(way)
-        return result
-    return None
+    return [node_pool.get_id(lonlat[1], lonlat[0]) for lonlat in linestring]
 
 
 def _way_to_wkt(node_pool, refs):
@@ -74,8 +130,45 @@ def _way_to_wkt(node_pool, refs):
     return f"({','.join(coords_sequence)})"
 
 
-def borders_to_xml(borders):
-    node_pool = {'id': 1}  # 'lat_lon': id
+def _join_chunks(pieces, chunk_size=64*1024):
+    """Joins small string pieces into chunks of about chunk_size length"""
+    chunk = []
+    length = 0
+    for piece in pieces:
+        chunk.append(piece)
+        length += len(piece)
+        if length >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def _iter_nodes_xml(node_pool):
+    for node_id, lat, lon in node_pool:
+        yield (f'<node id="{node_id}" visible="true" version="1" '
+               f'lat="{lat}" lon="{lon}" />')
+
+
+def _iter_way_xml(way_id, refs, tags=()):
+    yield f'<way id="{way_id}" visible="true" version="1">'
+    yield from tags
+    for nd in refs:
+        yield f'<nd ref="{nd}" />'
+    yield '</way>'
+
+
+def borders_to_xml(borders, topology=None):
+    """Yields OSM XML document with the borders by chunks.
+    All borders are read before the first chunk since nodes go first.
+    In topology mode rings are split at junction nodes, so that a common
+    part of borders of neighbour regions is exported as one way
+    referenced by both regions.
+    """
+    if topology is None:
+        topology = config.JOSM_TOPOLOGY
+    node_pool = NodePool()
     regions = []  # { id: id, name: name, rings: [['outer', [ids]], ['inner', [ids]], ...] }
     for border in borders:
         geometry = border['geometry']
@@ -92,56 +185,55 @@ def borders_to_xml(borders):
                 'disabled': border['properties']['disabled'],
                 'rings': rings
             })
+    yield from _join_chunks(_iter_borders_xml(node_pool, regions, topology))
+
 
-    xml = get_xml_header()
+def _iter_borders_xml(node_pool, regions, topology):
+    yield get_xml_header()
+    yield from _iter_nodes_xml(node_pool)
 
-    for latlon, node_id in node_pool.items():
-        if latlon != 'id':
-            (lat, lon) = latlon.split()
-            xml += (f'<node id="{node_id}" visible="true" version="1" '
-                    f'lat="{lat}" lon="{lon}" />')
+    if topology:
+        junctions = _find_junctions(regions)
+        split_ring = lambda refs: _split_ring(refs, junctions)
+    else:
+        split_ring = lambda refs: [refs]
 
-    ways = {}  # _ring_hash => id
-    wrid = 1
+    ways = {}  # _way_key => id
+    # Simple ways get ids of their regions, so member ways
+    # of relations get ids above all of them
+    wrid = max((region['id'] for region in regions), default=0) + 1
     for region in regions:
-        w1key = _ring_hash(region['rings'][0][1])
+        tags = [f'<tag k="name" v={_quoteattr(region["name"])} />']
+        if region['disabled']:
+            tags.append('<tag k="disabled" v="yes" />')
+        ring_ways = [(role, split_ring(refs)) for role, refs in region['rings']]
         if (not config.JOSM_FORCE_MULTI and
-                len(region['rings']) == 1 and
-                w1key not in ways
+                len(ring_ways) == 1 and
+                len(ring_ways[0][1]) == 1 and
+                _way_key(ring_ways[0][1][0]) not in ways
         ):
             # simple case: a way
-            ways[w1key] = region['id']
-            xml += f'''<way id="{region['id']}" visible="true" version="1">'''
-            xml += f'''<tag k="name" v={region['name']} />'''
-            if region['disabled']:
-                xml += '<tag k="disabled" v="yes" />'
-            for nd in region['rings'][0][1]:
-                xml += f'<nd ref="{nd}" />'
-            xml += '</way>'
+            ways[_way_key(ring_ways[0][1][0])] = region['id']
+            yield from _iter_way_xml(region['id'], ring_ways[0][1][0], tags)
         else:
-            # multipolygon
-            rxml = f'''<relation id="{region['id']}" visible="true" version="1">'''
-            wrid += 1
-            rxml += '<tag k="type" v="multipolygon" />'
-            rxml += f'''<tag k="name" v={_quoteattr(region['name'])} />'''
-            if region['disabled']:
-                rxml += '<tag k="disabled" v="yes" />'
-            for ring in region['rings']:
-                wkey = _ring_hash(ring[1])
-                if wkey in ways:
-                    # already have that way
-                    rxml += f'<member type="way" ref="{ways[wkey]}" role="{ring[0]}" />'
-                else:
-                    ways[wkey] = wrid
-                    xml += f'<way id="{wrid}" visible="true" version="1">'
-                    rxml += f'<member type="way" ref="{wrid}" role="{ring[0]}" />'
-                    for nd in ring[1]:
-                        xml += f'<nd ref="{nd}" />'
-                    xml += '</way>'
-                    wrid += 1
-            xml += rxml + '</relation>'
-    xml += '</osm>'
-    return xml
+            # multipolygon; member ways go before the relation
+            rxml = [f'<relation id="{region["id"]}" visible="true" version="1">',
+                    '<tag k="type" v="multipolygon" />']
+            rxml.extend(tags)
+            for role, refs_list in ring_ways:
+                for refs in refs_list:
+                    wkey = _way_key(refs)
+                    if wkey in ways:
+                        # already have that way
+                        rxml.append(f'<member type="way" ref="{ways[wkey]}" role="{role}" />')
+                    else:
+                        ways[wkey] = wrid
+                        yield from _iter_way_xml(wrid, refs)
+                        rxml.append(f'<member type="way" ref="{wrid}" role="{role}" />')
+                        wrid += 1
+            yield from rxml
+            yield '</relation>'
+    yield '</osm>'
 
 
 def _extend_bbox(bbox, *args):
@@ -164,6 +256,182 @@ def _bbox_contains(outer, inner):
             outer[3] >= inner[3])
 
 
+class BBoxIndex:
+    """Static R-tree of bboxes packed into arrays level by level.
+    Bboxes are sorted by their centers with the Sort-Tile-Recursive
+    algorithm, so that each node of 'node_size' children covers
+    a compact area.
+    """
+
+    def __init__(self, bboxes, node_size=16):
+        self.node_size = node_size
+        count = len(bboxes)
+        # Sort-Tile-Recursive: sort by x, cut into vertical slices,
+        # sort each slice by y
+        center_x = lambda i: bboxes[i][0] + bboxes[i][2]
+        center_y = lambda i: bboxes[i][1] + bboxes[i][3]
+        order = sorted(range(count), key=center_x)
+        leaves_count = math.ceil(count / node_size)
+        slice_size = node_size * math.ceil(math.sqrt(leaves_count)) or 1
+        self.order = []
+        for start in range(0, count, slice_size):
+            self.order.extend(sorted(order[start:start + slice_size],
+                                     key=center_y))
+        level = array('d')
+        for i in self.order:
+            level.extend(bboxes[i])
+        self.levels = [level]  # flat [xmin, ymin, xmax, ymax, ...] arrays
+        while len(level) > 4 * node_size:
+            parent_level = array('d')
+            for start in range(0, len(level), 4 * node_size):
+                bbox = list(level[start:start + 4])
+                for j in range(start + 4, min(start + 4 * node_size, len(level)), 4):
+                    _extend_bbox(bbox, level[j:j + 4])
+                parent_level.extend(bbox)
+            self.levels.append(parent_level)
+            level = parent_level
+
+    def search_containing(self, bbox):
+        """Returns indices of the bboxes which contain 'bbox'"""
+        result = []
+        top = len(self.levels) - 1
+        stack = [(top, i) for i in range(len(self.levels[top]) // 4)]
+        while stack:
+            level_number, i = stack.pop()
+            level = self.levels[level_number]
+            if not _bbox_contains(level[4 * i:4 * i + 4], bbox):
+                continue
+            if level_number == 0:
+                result.append(self.order[i])
+            else:
+                children_count = len(self.levels[level_number - 1]) // 4
+                stack.extend(
+                    (level_number - 1, j)
+                    for j in range(i * self.node_size,
+                                   min((i + 1) * self.node_size, children_count))
+                )
+        return result
+
+
+def _ring_area(nodes, refs):
+    """Planar area of the ring in square degrees"""
+    area = 0.0
+    for nd1, nd2 in zip(refs, refs[1:]):
+        area += (nodes[nd1]['lon'] * nodes[nd2]['lat'] -
+                 nodes[nd2]['lon'] * nodes[nd1]['lat'])
+    return abs(area) / 2
+
+
+def _point_in_ring(lon, lat, nodes, refs):
+    inside = False
+    for nd1, nd2 in zip(refs, refs[1:]):
+        lon1, lat1 = nodes[nd1]['lon'], nodes[nd1]['lat']
+        lon2, lat2 = nodes[nd2]['lon'], nodes[nd2]['lat']
+        if ((lat1 > lat) != (lat2 > lat) and
+                lon < lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1)):
+            inside = not inside
+    return inside
+
+
+def _ring_contains(nodes, outer_refs, inner_refs):
+    """Checks if the inner ring lies inside the outer one by a node of
+    the inner ring which doesn't belong to the outer ring, or by the middle
+    of an inner segment if all inner nodes are on the outer ring.
+    """
+    outer_nodes = set(outer_refs)
+    for nd in inner_refs:
+        if nd not in outer_nodes:
+            lon, lat = nodes[nd]['lon'], nodes[nd]['lat']
+            break
+    else:
+        nd1, nd2 = inner_refs[0], inner_refs[1]
+        lon = (nodes[nd1]['lon'] + nodes[nd2]['lon']) / 2
+        lat = (nodes[nd1]['lat'] + nodes[nd2]['lat']) / 2
+    return _point_in_ring(lon, lat, nodes, outer_refs)
+
+
+def _assign_inner_rings(nodes, outer, inner):
+    """Returns the list of inner rings of each outer ring. An inner ring
+    goes to the smallest outer ring containing it; inner rings outside
+    of all outer rings are dropped.
+    """
+    outer_index = BBoxIndex([way['bbox'] for way in outer])
+    outer_areas = {}
+    outer_inners = [[] for _ in outer]
+    for way in inner:
+        containing = [
+            i for i in outer_index.search_containing(way['bbox'])
+                if _ring_contains(nodes, outer[i]['nodes'], way['nodes'])
+        ]
+        if not containing:
+            continue
+        for i in containing:
+            if i not in outer_areas:
+                outer_areas[i] = _ring_area(nodes, outer[i]['nodes'])
+        smallest = min(containing, key=lambda i: outer_areas[i])
+        outer_inners[smallest].append(way)
+    return outer_inners
+
+
+def _assemble_rings(ways):
+    """Chains ways into closed rings by their end nodes in linear time.
+    Returns the list of {nodes, bbox}-dicts of rings, or None if some ways
+    cannot be closed into rings. Doesn't modify the ways.
+    """
+    # node id => indices of non-closed ways starting or ending at the node
+    ends = defaultdict(list)
+    for i, way in enumerate(ways):
+        if way['nodes'][0] != way['nodes'][-1]:
+            ends[way['nodes'][0]].append(i)
+            ends[way['nodes'][-1]].append(i)
+    used = [False] * len(ways)
+    rings = []
+    for i, way in enumerate(ways):
+        if used[i]:
+            continue
+        used[i] = True
+        nodes = list(way['nodes'])
+        if nodes[0] == nodes[-1]:
+            rings.append({'nodes': nodes, 'bbox': list(way['bbox'])})
+            continue
+        # (index in nodes of the first node, bbox) of chained ways
+        segments = [(0, way['bbox'])]
+        # end node of a chained way => its index in nodes
+        positions = {nodes[0]: 0}
+        while True:
+            k = positions.get(nodes[-1])
+            if k is not None:
+                # The chain has come back to its node, which happens
+                # if polygons touch at a vertex: ways after the node
+                # form a separate ring.
+                bbox = [1e4, 1e4, -1e4, -1e4]
+                while segments and segments[-1][0] >= k:
+                    segment_start, segment_bbox = segments.pop()
+                    if segment_start > k:
+                        del positions[nodes[segment_start]]
+                    _extend_bbox(bbox, segment_bbox)
+                rings.append({'nodes': nodes[k:], 'bbox': bbox})
+                del nodes[k + 1:]
+                if k == 0:
+                    break
+            else:
+                positions[nodes[-1]] = len(nodes) - 1
+            candidates = ends[nodes[-1]]
+            while candidates and used[candidates[-1]]:
+                candidates.pop()
+            if not candidates:
+                return None
+            j = candidates.pop()
+            used[j] = True
+            segments.append((len(nodes) - 1, ways[j]['bbox']))
+            next_nodes = ways[j]['nodes']
+            if next_nodes[0] == nodes[-1]:
+                nodes.extend(next_nodes[1:])
+            else:
+                nodes.extend(reversed(next_nodes[:-1]))
+    return rings
+
+
 def borders_from_xml(doc_tree):
     """Returns regions dict or str with error message."""
     root = doc_tree.getroot()
@@ -246,29 +514,10 @@ def borders_from_xml(doc_tree):
         if len(outer) == 0:
             return f"Relation {rel.get('id')} has no outer ways"
         # reconstruct rings in multipolygon
-        for multi in (inner, outer):
-            i = 0
-            while i < len(multi):
-                way = multi[i]['nodes']
-                while way[0] != way[-1]:
-                    productive = False
-                    j = i + 1
-                    while way[0] != way[-1] and j < len(multi):
-                        new_way = _append_way(way, multi[j]['nodes'])
-                        if new_way:
-                            multi[i] = dict(multi[i])
-                            multi[i]['nodes'] = new_way
-                            way = new_way
-                            if multi[j]['modified']:
-                                multi[i]['modified'] = True
-                            _extend_bbox(multi[i]['bbox'], multi[j]['bbox'])
-                            del multi[j]
-                            productive = True
-                        else:
-                            j += 1
-                    if not productive:
-                        return f"Unconnected way in relation {rel.get('id')}"
-                i += 1
+        outer = _assemble_rings(outer)
+        inner = _assemble_rings(inner)
+        if outer is None or inner is None:
+            return f"Unconnected way in relation {rel.get('id')}"
         # check for 2-node rings
         for multi in (outer, inner):
             for way in multi:
@@ -276,12 +525,11 @@ def borders_from_xml(doc_tree):
                     return f"Way in relation {rel.get('id')} has only {len(way['nodes'])} nodes"
         # sort inner and outer rings
         polygons = []
-        for way in outer:
+        outer_inners = _assign_inner_rings(nodes, outer, inner)
+        for way, way_inners in zip(outer, outer_inners):
             rings = [_way_to_wkt(nodes, way['nodes'])]
-            for i in range(len(inner)-1, -1, -1):
-                if _bbox_contains(way['bbox'], inner[i]['bbox']):
-                    rings.append(_way_to_wkt(nodes, inner[i]['nodes']))
-                    del inner[i]
+            rings.extend(_way_to_wkt(nodes, inner_way['nodes'])
+                         for inner_way in way_inners)
             polygons.append('({})'.format(','.join(rings)))
         regions[osm_id] = {
                 'id': osm_id,
@@ -316,7 +564,8 @@ def borders_from_xml(doc_tree):
 
 
 def lines_to_xml(lines_geojson_iterable):
-    node_pool = {'id': 1}  # 'lat_lon': id
+    """Yields OSM XML document with the lines by chunks"""
+    node_pool = NodePool()
     lines = []
     for feature in lines_geojson_iterable:
         geometry = json.loads(feature)
@@ -328,20 +577,12 @@ def lines_to_xml(lines_geojson_iterable):
                 nodes.extend(_parse_linestring(node_pool, line))
         if len(nodes) > 0:
             lines.append(nodes)
+    yield from _join_chunks(_iter_lines_xml(node_pool, lines))
+
 
-    xml = get_xml_header()
-
-    for latlon, node_id in node_pool.items():
-        if latlon != 'id':
-            (lat, lon) = latlon.split()
-            xml += (f'<node id="{node_id}" visible="true" version="1" '
-                    f'lat="{lat}" lon="{lon}" />')
-    wrid = 1
-    for line in lines:
-        xml += f'<way id="{wrid}" visible="true" version="1">'
-        for nd in line:
-            xml += f'<nd ref="{nd}" />'
-        xml += '</way>'
-        wrid += 1
-    xml += '</osm>'
-    return xml
+def _iter_lines_xml(node_pool, lines):
+    yield get_xml_header()
+    yield from _iter_nodes_xml(node_pool)
+    for wrid, line in enumerate(lines, 1):
+        yield from _iter_way_xml(wrid, line)
+    yield '</osm>'
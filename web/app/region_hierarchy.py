@@ -0,0 +1,121 @@
+import threading
+
+from config import (
+    BORDERS_TABLE as borders_table,
+    HIERARCHY_VERSION_SEQUENCE as hierarchy_version_sequence,
+)
+
+
+class RegionHierarchy:
+    """In-memory index of the parent-child relations of the borders table.
+
+    Any committed change of ids, names or parents in the borders table
+    advances the version sequence (see create_tables.sql), so an index
+    can be validated with a single cheap query.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.parents = {}  # region_id => parent_id or None
+        self.children = {}  # region_id => list of child ids
+        self.names = {}  # region_id => name
+        self.admin_levels = {}  # region_id => admin_level or None
+
+    def load(self, conn):
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT id, parent_id, name, admin_level
+                FROM {borders_table}
+                """
+            )
+            for region_id, parent_id, name, admin_level in cursor:
+                self.parents[region_id] = parent_id
+                self.names[region_id] = name
+                self.admin_levels[region_id] = admin_level
+                self.children.setdefault(region_id, [])
+                if parent_id is not None:
+                    self.children.setdefault(parent_id, []).append(region_id)
+
+    def __contains__(self, region_id):
+        return region_id in self.parents
+
+    def get_predecessors(self, region_id):
+        """Returns the list of (id, name)-tuples of all predecessors,
+        starting from the very region_id.
+        """
+        predecessors = []
+        while True:
+            if region_id not in self.parents:
+                raise Exception(
+                    f"No record in '{borders_table}' table with id = {region_id}"
+                )
+            predecessors.append((region_id, self.names[region_id]))
+            parent_id = self.parents[region_id]
+            if not parent_id:
+                break
+            region_id = parent_id
+        return predecessors
+
+    def get_parent_id(self, region_id):
+        return self.parents.get(region_id)
+
+    def get_child_ids(self, region_id):
+        return list(self.children.get(region_id, []))
+
+    def is_leaf(self, region_id):
+        return not self.children.get(region_id)
+
+    def get_osm_children(self, region_id):
+        """Returns the list of {id, admin_level}-dicts of children
+        that are present in the OSM borders table.
+        """
+        return [{'id': child_id, 'admin_level': self.admin_levels[child_id]}
+                for child_id in self.children.get(region_id, [])
+                    if self.admin_levels[child_id] is not None]
+
+
+_hierarchy = None
+_hierarchy_lock = threading.Lock()
+# Hierarchy with uncommitted changes of the current transaction
+# of the thread, keyed by the id of the last change
+_local = threading.local()
+
+
+def get_region_hierarchy(conn):
+    """Returns the hierarchy index of the current process,
+    reloading it if the borders table has been changed since last load.
+    If the current transaction of 'conn' has changed the hierarchy,
+    a separate index with these changes is loaded, which is reused
+    by the thread until the next change.
+    """
+    global _hierarchy
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT last_value,
+                   current_setting('borders.hierarchy_changed', TRUE)
+            FROM {hierarchy_version_sequence}
+            """
+        )
+        version, change_id = cursor.fetchone()
+    # The setting is reset to '' after the transaction
+    if change_id:
+        hierarchy = getattr(_local, 'hierarchy', None)
+        if hierarchy is None or hierarchy.version != change_id:
+            hierarchy = RegionHierarchy(change_id)
+            hierarchy.load(conn)
+            _local.hierarchy = hierarchy
+        return hierarchy
+    _local.hierarchy = None
+    with _hierarchy_lock:
+        if _hierarchy is None or _hierarchy.version != version:
+            # The version seen while some changes are being committed
+            # may not match the loaded data, so it's not cached
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT borders_hierarchy_stable_version()")
+                stable_version = cursor.fetchone()[0]
+            hierarchy = RegionHierarchy(stable_version)
+            hierarchy.load(conn)
+            if stable_version is None:
+                return hierarchy
+            _hierarchy = hierarchy
+        return _hierarchy
@@ -83,6 +83,13 @@ function init() {
         if (e.keyCode == 13)
             $('#b_search').click();
     });
+    $('#fsearch').on('input', function() {
+        var query = $('#fsearch').val();
+        if (query in searchSuggestions)
+            zoomToFound({'bounds': searchSuggestions[query]});
+        else
+            suggestSearch();
+    });
     $('#b_comment').keyup(function(e) {
         if (e.keyCode == 13)
             $('#b_comment_send').click();
@@ -178,6 +185,92 @@ function makeAnswerHandler(on_ok_func) {
     };
 }
 
+// Runs the long operation 'method' as a server job and shows its progress.
+// 'on_done' is called with the result of a successfully done job,
+// 'on_finish' - when the job is over in any way.
+function runJob(method, params, on_done, on_finish) {
+    var finish = function() {
+        jobId = null;
+        $('#job').hide();
+        if (on_finish)
+            on_finish();
+    };
+    if (jobId !== null) {
+        alert('Дождитесь окончания предыдущей операции');
+        if (on_finish)
+            on_finish();
+        return;
+    }
+    jobId = -1; // reserved until the server returns the id
+    $.ajax(getServer(method), {
+        data: $.extend({'async': true}, params),
+        success: function(answer) {
+            if (answer.status !== 'ok') {
+                alert(answer.status);
+                finish();
+                return;
+            }
+            jobId = answer.job_id;
+            $('#job_text').text('В очереди');
+            $('#job').show();
+            pollJob(answer.job_id, on_done, finish);
+        },
+        error: finish
+    });
+}
+
+function pollJob(job_id, on_done, finish) {
+    var pollLater = function() {
+        setTimeout(function() {
+            pollJob(job_id, on_done, finish);
+        }, JOB_POLL_INTERVAL);
+    };
+    $.ajax(getServer('job'), {
+        data: {
+            'id': job_id
+        },
+        success: function(answer) {
+            if (answer.status !== 'ok') {
+                alert(answer.status);
+                finish();
+                return;
+            }
+            var job = answer.job;
+            if (job.status == 'queued') {
+                $('#job_text').text('В очереди');
+                pollLater();
+            }
+            else if (job.status == 'running') {
+                $('#job_text').text('Выполнено ' +
+                    Math.round(job.progress * 100) + '%');
+                pollLater();
+            }
+            else {
+                finish();
+                if (job.status == 'done')
+                    on_done(job.result);
+                else if (job.status == 'failed')
+                    alert('Ошибка: ' + job.message);
+            }
+        },
+        // the server may be restarting
+        error: pollLater
+    });
+}
+
+function bJobCancel() {
+    if (jobId === null || jobId < 0)
+        return;
+    $.ajax(getServer('job_cancel'), {
+        data: {
+            'id': jobId
+        },
+        success: makeAnswerHandler(function() {
+            $('#job_text').text('Отменяется...');
+        })
+    });
+}
+
 function processBorders(data) {
     data = data.geojson;
     for (var id in borders) {
@@ -453,6 +546,43 @@ function doSearch() {
     }
 }
 
+var searchSuggestions = {}; // full name => bounds
+var SEARCH_SUGGEST_DELAY = 300; // ms
+var suggestTimer = null;
+var suggestQuery = null; // the last requested query
+
+function suggestSearch() {
+    clearTimeout(suggestTimer);
+    suggestTimer = setTimeout(function() {
+        var query = $('#fsearch').val();
+        if (query.length < 2 || query in searchSuggestions ||
+                query === suggestQuery)
+            return;
+        suggestQuery = query;
+        $.ajax(getServer('search_suggest'), {
+            data: {
+                'q': query
+            },
+            success: makeAnswerHandler(function(result) {
+                // responses may come out of order
+                if (query === suggestQuery)
+                    updateSearchSuggestions(result);
+            })
+        });
+    }, SEARCH_SUGGEST_DELAY);
+}
+
+function updateSearchSuggestions(result) {
+    var list = $('#fsearch_list');
+    list.empty();
+    searchSuggestions = {};
+    for (var i = 0; i < result.regions.length; i++) {
+        var region = result.regions[i];
+        searchSuggestions[region.full_name] = region.bounds;
+        list.append($('<option>').attr('value', region.full_name));
+    }
+}
+
 function zoomToFound(result) {
     $('#fsearch').val('');
     if (!('bounds' in result))
@@ -1006,6 +1136,9 @@ function bPointCancel() {
     map.removeLayer(pMarker);
 }
 
+var JOB_POLL_INTERVAL = 2000; // ms
+var jobId = null; // server job being run, one at a time
+
 var subregionsLayer = null,
     clustersLayer = null,
     divSelectedId = null;
@@ -1073,9 +1206,10 @@ function bDividePreview() {
     if (auto_divide) {
         params['mwm_size_thr'] = parseInt($('#mwm_size_thr').val()) * 1024;
     }
-    $.ajax(getServer('divide_preview'), {
-        data: params,
-        success: makeAnswerHandler(bDivideDrawPreview)
+    runJob('divide_preview', params, function(result) {
+        // the division may have been abandoned while the job was running
+        if (divSelectedId == params['id'])
+            bDivideDrawPreview(result);
     });
 }
 
@@ -1136,10 +1270,7 @@ function bDivideDo() {
     if (auto_divide) {
         params['mwm_size_thr'] = parseInt($('#mwm_size_thr').val()) * 1024;
     }
-    $.ajax(getServer('divide'), {
-        data: params,
-        success: updateBorders
-    });
+    runJob('divide', params, updateBorders);
     bDivideCancel();
 }
 
@@ -1225,11 +1356,12 @@ function updateBackupList(data) {
 }
 
 function bBackupSave() {
-    $.ajax(getServer('backup'), {
-        success: bBackupCancel
-    });
     $('#backup_save').attr('disabled', true);
     $('#backup_saving').css('display', 'block');
+    runJob('backup', {}, bBackupCancel, function() {
+        $('#backup_save').attr('disabled', false);
+        $('#backup_saving').css('display', 'none');
+    });
 }
 
 function bBackupRestore(timestamp) {
@@ -1283,18 +1415,14 @@ function startOver() {
         bBackupCancel();
         selectLayer(null);
         $('#wait_start_over').show();
-        $.ajax(getServer('start_over'), {
-            success: makeAnswerHandler(function() {
-                for (var id in borders) {
-                    bordersLayer.removeLayer(borders[id].layer);
-                    delete borders[id];
-                }
-                updateBorders();
-            }),
-            complete: function() {
-                $('#wait_start_over').hide();
+        runJob('start_over', {}, function() {
+            for (var id in borders) {
+                bordersLayer.removeLayer(borders[id].layer);
+                delete borders[id];
             }
-
+            updateBorders();
+        }, function() {
+            $('#wait_start_over').hide();
         });
     }
 }
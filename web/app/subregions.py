@@ -1,6 +1,8 @@
 import math
 from queue import Queue
 
+from psycopg2.extras import execute_values
+
 from config import (
     BORDERS_TABLE as borders_table,
     MWM_SIZE_PREDICTION_MODEL_LIMITATIONS,
@@ -8,6 +10,7 @@ from config import (
     OSM_PLACES_TABLE as osm_places_table,
 )
 from mwm_size_predictor import MwmSizePredictor
+from region_hierarchy import get_region_hierarchy
 
 
 def get_subregions_info(conn, region_id, region_table,
@@ -34,13 +37,9 @@ def get_subregions_info(conn, region_id, region_table,
 def _get_subregions_basic_info(conn, region_id, region_table,
                                next_level):
     cursor = conn.cursor()
-    region_id_column, region_geom_column = (
-        ('id', 'geom') if region_table == borders_table else
-        ('osm_id', 'way')
-    )
+    region_id_column, region_geom_column = _get_id_and_geom_columns(region_table)
     cursor.execute(f"""
-        SELECT subreg.osm_id, subreg.name,
-               ST_Area(geography(subreg.way))/1.0E+6 area
+        SELECT subreg.osm_id, subreg.name, subreg.area_km2
         FROM {region_table} reg, {osm_table} subreg
         WHERE reg.{region_id_column} = %s AND subreg.admin_level = %s AND
               ST_Contains(reg.{region_geom_column}, subreg.way)
@@ -57,9 +56,15 @@ def _get_subregions_basic_info(conn, region_id, region_table,
     return subregions
 
 
-def _add_population_data(conn, subregions, need_cities):
+def _get_id_and_geom_columns(region_table):
+    return (('id', 'geom') if region_table == borders_table else
+            ('osm_id', 'way'))
+
+
+def _add_population_data(conn, subregions, need_cities,
+                         region_table=osm_table):
     """Adds population data only for subregions that are suitable
-    for mwm size estimation.
+    for mwm size estimation. Subregion ids refer to 'region_table'.
     """
     subregion_ids = [
         s_id for s_id, s_data in subregions.items()
@@ -78,12 +83,13 @@ def _add_population_data(conn, subregions, need_cities):
             data['cities'] = []
 
     subregion_ids_str = ','.join(str(x) for x in subregion_ids)
+    id_column, geom_column = _get_id_and_geom_columns(region_table)
     with conn.cursor() as cursor:
         cursor.execute(f"""
-            SELECT b.osm_id, p.name, coalesce(p.population, 0), p.place
-            FROM {osm_table} b, {osm_places_table} p
-            WHERE b.osm_id IN ({subregion_ids_str})
-                AND ST_Contains(b.way, p.center)
+            SELECT b.{id_column}, p.name, coalesce(p.population, 0), p.place
+            FROM {region_table} b, {osm_places_table} p
+            WHERE b.{id_column} IN ({subregion_ids_str})
+                AND ST_Contains(b.{geom_column}, p.center)
             """
         )
         for subregion_id, place_name, place_population, place_type in cursor:
@@ -100,12 +106,19 @@ def _add_population_data(conn, subregions, need_cities):
                 subregion_data['hamlet_cnt'] += 1
 
 
-def _add_mwm_size_estimation(conn, subregions, need_cities):
+def _add_mwm_size_estimation(conn, subregions, need_cities,
+                             region_table=osm_table):
+    _add_population_data(conn, subregions, need_cities, region_table)
+    predict_mwm_size(subregions)
+
+
+def predict_mwm_size(subregions):
+    """Sets 'mwm_size_est' for subregions with area and population data,
+    making one prediction call for all of them.
+    """
     for subregion_data in subregions.values():
         subregion_data['mwm_size_est'] = None
 
-    _add_population_data(conn, subregions, need_cities)
-
     subregions_to_predict = [
         (
             s_id,
@@ -131,30 +144,56 @@ def _add_mwm_size_estimation(conn, subregions, need_cities):
         subregions[subregion_id]['mwm_size_est'] = mwm_size_prediction
 
 
-def update_border_mwm_size_estimation(conn, border_id):
+def update_borders_mwm_size_estimation(conn, border_ids):
+    """Estimates mwm size of many borders with one area query, one population
+    query and one prediction call, and stores it with one UPDATE.
+    Doesn't commit. Returns the list of warnings for borders
+    whose mwm size cannot be estimated.
+    """
+    borders, warnings = get_borders_estimation_data(conn, border_ids)
+    predict_mwm_size(borders)
+    save_borders_mwm_size_estimation(conn, borders)
+    return warnings
+
+
+def get_borders_estimation_data(conn, border_ids):
+    """Returns dict {border_id => border data with area and population info}
+    and the list of warnings for borders that cannot be estimated.
+    """
+    warnings = []
+    borders = {}
     with conn.cursor() as cursor:
         cursor.execute(f"""
-            SELECT name, ST_Area(geography(geom))/1.0E+6 area
+            SELECT id, name, area_km2
             FROM {borders_table}
-            WHERE id = %s""", (border_id,))
-        name, area = cursor.fetchone()
-        if math.isnan(area):
-            e = Exception(f"Area is NaN for border '{name}' ({border_id})")
-            raise e
-        border_data = {
-            'area': area,
-        }
-        regions = {border_id: border_data}
-        _add_mwm_size_estimation(conn, regions, need_cities=False)
-        mwm_size_est = border_data.get('mwm_size_est')
-        # mwm_size_est may be None. Python's None is converted to NULL
-        # duging %s substitution in execute().
-        cursor.execute(f"""
-            UPDATE {borders_table}
-            SET mwm_size_est = %s
-            WHERE id = %s
-            """, (mwm_size_est, border_id,))
-        conn.commit()
+            WHERE id = ANY(%s)""", (list(border_ids),))
+        for border_id, name, area in cursor:
+            if math.isnan(area):
+                warnings.append(f"Area is NaN for border '{name}' ({border_id})")
+            else:
+                borders[border_id] = {'area': area}
+    if borders:
+        _add_population_data(conn, borders, need_cities=False,
+                             region_table=borders_table)
+    return borders, warnings
+
+
+def save_borders_mwm_size_estimation(conn, borders):
+    """Stores 'mwm_size_est' of borders (dict {border_id => border data})."""
+    if not borders:
+        return
+    # mwm_size_est may be None which is converted to NULL
+    values = [(border_id, border_data['mwm_size_est'])
+              for border_id, border_data in borders.items()]
+    with conn.cursor() as cursor:
+        execute_values(cursor, f"""
+            UPDATE {borders_table} b
+            SET mwm_size_est = v.mwm_size_est
+            FROM (VALUES %s) AS v(id, mwm_size_est)
+            WHERE b.id = v.id
+            """, values, template='(%s::BIGINT, %s::REAL)',
+            page_size=len(values)
+        )
 
 
 def is_administrative_region(conn, region_id):
@@ -168,74 +207,48 @@ def is_administrative_region(conn, region_id):
 
 
 def is_leaf(conn, region_id):
-    cursor = conn.cursor()
-    cursor.execute(f"""
-        SELECT count(1)
-        FROM {borders_table}
-        WHERE parent_id = %s
-        """, (region_id,)
-    )
-    count = cursor.fetchone()[0]
-    return (count == 0)
-
-
-def get_region_country(conn, region_id):
-    """Returns the uppermost predecessor of the region in the hierarchy,
-    possibly itself.
-    """
-    predecessors = get_predecessors(conn, region_id)
-    return predecessors[-1]
+    return get_region_hierarchy(conn).is_leaf(region_id)
 
 
 def get_predecessors(conn, region_id):
     """Returns the list of (id, name)-tuples of all predecessors,
     starting from the very region_id.
     """
-    predecessors = []
-    cursor = conn.cursor()
-    while True:
-        cursor.execute(f"""
-            SELECT id, name, parent_id
-            FROM {borders_table} WHERE id = %s
-            """, (region_id,)
-        )
-        rec = cursor.fetchone()
-        if not rec:
-           raise Exception(
-               f"No record in '{borders_table}' table with id = {region_id}"
-           )
-        predecessors.append(rec[0:2])
-        parent_id = rec[2]
-        if not parent_id:
-            break
-        region_id = parent_id
-    return predecessors
+    return get_region_hierarchy(conn).get_predecessors(region_id)
+
+
+def get_predecessors_bulk(conn, region_ids):
+    """Returns dict {region_id: list of (id, name)-tuples of all predecessors,
+    starting from the very region_id} for all given regions.
+    Regions absent in the table are absent in the result.
+    """
+    hierarchy = get_region_hierarchy(conn)
+    return {region_id: hierarchy.get_predecessors(region_id)
+            for region_id in region_ids if region_id in hierarchy}
 
 
 def get_region_full_name(conn, region_id):
     predecessors = get_predecessors(conn, region_id)
+    return _predecessors_to_full_name(predecessors)
+
+
+def get_regions_full_names(conn, region_ids):
+    """Returns dict {region_id: full_name} for all given regions."""
+    predecessors = get_predecessors_bulk(conn, region_ids)
+    return {region_id: _predecessors_to_full_name(region_predecessors)
+            for region_id, region_predecessors in predecessors.items()}
+
+
+def _predecessors_to_full_name(predecessors):
     return '_'.join(pr[1] for pr in reversed(predecessors))
 
 
 def get_parent_region_id(conn, region_id):
-    cursor = conn.cursor()
-    cursor.execute(f"""
-        SELECT parent_id FROM {borders_table} WHERE id = %s
-        """, (region_id,))
-    rec = cursor.fetchone()
-    parent_id = int(rec[0]) if rec and rec[0] is not None else None
-    return parent_id
+    return get_region_hierarchy(conn).get_parent_id(region_id)
 
 
 def get_child_region_ids(conn, region_id):
-    cursor = conn.cursor()
-    cursor.execute(f"""
-        SELECT id FROM {borders_table} WHERE parent_id = %s
-        """, (region_id,))
-    child_ids = []
-    for rec in cursor:
-        child_ids.append(int(rec[0]))
-    return child_ids
+    return get_region_hierarchy(conn).get_child_ids(region_id)
 
 
 def get_similar_regions(conn, region_id, only_leaves=False):
@@ -248,7 +261,8 @@ def get_similar_regions(conn, region_id, only_leaves=False):
         WHERE osm_id = %s""", (region_id,)
     )
     admin_level = int(cursor.fetchone()[0])
-    country_id, country_name = get_region_country(conn, region_id)
+    hierarchy = get_region_hierarchy(conn)
+    country_id, country_name = hierarchy.get_predecessors(region_id)[-1]
     q = Queue()
     q.put({'id': country_id, 'admin_level': 2})
     similar_region_ids = []
@@ -257,25 +271,10 @@ def get_similar_regions(conn, region_id, only_leaves=False):
         if item['admin_level'] == admin_level:
             similar_region_ids.append(item['id'])
         elif item['admin_level'] < admin_level:
-            children = find_osm_child_regions(conn, item['id'])
+            children = hierarchy.get_osm_children(item['id'])
             for ch in children:
                 q.put(ch)
     if only_leaves:
         similar_region_ids = [r_id for r_id in similar_region_ids
-                                  if is_leaf(conn, r_id)]
+                                  if hierarchy.is_leaf(r_id)]
     return similar_region_ids
-
-
-def find_osm_child_regions(conn, region_id):
-    children = []
-    with conn.cursor() as cursor:
-        cursor.execute(f"""
-            SELECT c.id, oc.admin_level
-            FROM {borders_table} c, {borders_table} p, {osm_table} oc
-            WHERE p.id = c.parent_id AND c.id = oc.osm_id
-                AND p.id = %s
-            """, (region_id,)
-        )
-        for osm_id, admin_level in cursor:
-            children.append({'id': osm_id, 'admin_level': admin_level})
-    return children